@@ -0,0 +1,156 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+
+from speech_chunker import (AudioCache, RuntimeConfig, ShadowFormatter,
+                            SpeechChunker)
+
+
+def timestamp(ms, separator=","):
+    ms = int(round(ms))
+    return "{:02d}:{:02d}:{:02d}{}{:03d}".format(
+        ms // 3600000, ms // 60000 % 60, ms // 1000 % 60, separator,
+        ms % 1000)
+
+
+def srt(entries):
+    return "".join("{}\n{} --> {}\n{}\n\n".format(
+        i, timestamp(start), timestamp(end), text)
+        for i, (start, end, text) in enumerate(entries, 1))
+
+
+def vtt(entries):
+    return "WEBVTT\n\n" + "".join("{} --> {}\n{}\n\n".format(
+        timestamp(start, "."), timestamp(end, "."), text)
+        for start, end, text in entries)
+
+
+def write(path, text):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def prepare(source, directory, format="wav", chunk_duration=10, threads=1,
+            backend="torch"):
+    os.makedirs(directory, exist_ok=True)
+    runtime = RuntimeConfig(threads=threads, backend=backend)
+    chunker = SpeechChunker(chunk_duration, runtime=runtime)
+    chunker.url = source
+    chunker.load()
+    formatter = ShadowFormatter(chunker, runtime=runtime)
+    subtitles = formatter.transcribe()
+    timeline = formatter.timeline()
+
+    phrases = [{"index": i, "start": start, "end": end,
+                "shadow_start": shadow_start, "shadow_end": shadow_end,
+                "repeat_end": repeat_end, "text": subtitles[i]}
+               for i, ((start, end), (shadow_start, shadow_end, repeat_end))
+               in enumerate(zip(chunker.phrases, timeline))]
+    # Subtitles follow the shadow track and stay up while the phrase is
+    # repeated.
+    entries = [(i["shadow_start"], i["repeat_end"], i["text"])
+               for i in phrases]
+
+    outputs = {
+        "phrases": os.path.join(directory, "phrases.json"),
+        "srt": os.path.join(directory, "subtitles.srt"),
+        "vtt": os.path.join(directory, "subtitles.vtt"),
+        "shadow": os.path.join(directory, "shadow." + format),
+    }
+    write(outputs["phrases"], json.dumps(
+        {"source": source, "digest": chunker.digest, "phrases": phrases},
+        indent=2))
+    write(outputs["srt"], srt(entries))
+    write(outputs["vtt"], vtt(entries))
+    tmp = outputs["shadow"] + ".tmp"
+    formatter.export(tmp, format=format)
+    os.replace(tmp, outputs["shadow"])
+    return outputs
+
+
+class Manifest:
+
+    def __init__(self, path):
+        self._path = path
+        self._entries = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    def done(self, source):
+        return self._entries.get(source, {}).get("status") == "done"
+
+    def update(self, source, **entry):
+        self._entries[source] = entry
+        write(self._path, json.dumps(self._entries, indent=2))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def inputs(args):
+    sources = list(args.inputs)
+    if args.list:
+        with open(args.list) as f:
+            sources += [i.strip() for i in f
+                        if i.strip() and not i.startswith("#")]
+    return list(dict.fromkeys(sources))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Prepare shadowing material for many videos or files.")
+    parser.add_argument("inputs", nargs="*", help="URLs or local files")
+    parser.add_argument("--list", help="File with one URL or path per line")
+    parser.add_argument("--output", default="echomaster-batch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", type=int, default=1,
+                        help="torch threads per worker")
+    parser.add_argument("--backend", choices=("torch", "onnx"),
+                        default="torch", help="Inference backend")
+    parser.add_argument("--format", default="wav",
+                        help="Audio format of the shadow tracks")
+    parser.add_argument("--chunk-duration", type=int, default=10)
+    parser.add_argument("--force", action="store_true",
+                        help="Process inputs that are already done")
+    args = parser.parse_args(argv)
+
+    sources = inputs(args)
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(os.path.join(args.output, "manifest.json"))
+    pending = [i for i in sources if args.force or not manifest.done(i)]
+    print("{} inputs, {} already done".format(
+        len(sources), len(sources) - len(pending)), file=sys.stderr)
+
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        futures = {}
+        for source in pending:
+            directory = os.path.join(args.output, AudioCache.key(source))
+            futures[pool.submit(
+                prepare, source, directory, args.format,
+                args.chunk_duration, args.threads, args.backend)] = (
+                source, directory)
+        # The manifest is only written here, so workers never race on it.
+        for future in concurrent.futures.as_completed(futures):
+            source, directory = futures[future]
+            try:
+                outputs = future.result()
+            except Exception as e:
+                failed += 1
+                manifest.update(source, status="failed", directory=directory,
+                                error="{}: {}".format(type(e).__name__, e))
+                print("Failed {}: {}".format(source, e), file=sys.stderr)
+                continue
+            manifest.update(source, status="done", directory=directory,
+                            outputs=outputs)
+            print("Done {}".format(source), file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
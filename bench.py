@@ -0,0 +1,490 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+from pydub import AudioSegment
+
+from speech_chunker import (AudioCache, AudioEngine, JsonLinesSink,
+                            ModelRegistry, RuntimeConfig, Shadow,
+                            ShadowFormatter, SpeechChunker, SpeechComparator,
+                            SubtitleStore, Tracer, decode, dtw, waveform)
+
+
+# First three formants of a few English vowels.
+VOWELS = np.array([[730, 1090, 2440], [270, 2290, 3010], [300, 870, 2240],
+                   [530, 1840, 2480], [570, 840, 2410], [660, 1720, 2410]])
+
+
+def syllable(rng, f0, frame_rate):
+    n = int(rng.uniform(0.12, 0.3) * frame_rate)
+    t = np.arange(n) / frame_rate
+    pitch = f0 * (1 + rng.uniform(-0.15, 0.15) * t / t[-1])
+    phase = 2 * np.pi * np.cumsum(pitch) / frame_rate
+    formants = VOWELS[rng.integers(len(VOWELS))]
+    harmonics = np.arange(1, int(4000 / f0))
+    weights = np.exp(
+        -((harmonics[:, None] * f0 - formants) / 120)**2).sum(1) + 0.02
+    vowel = (weights[:, None] * np.sin(harmonics[:, None] * phase)).sum(0)
+    vowel *= np.hanning(n) / np.abs(vowel).max()
+    if rng.random() < 0.5:
+        # Fricative onset: high-passed noise burst.
+        noise = rng.standard_normal(int(rng.uniform(0.03, 0.08) * frame_rate))
+        noise = np.diff(noise, prepend=0) * np.hanning(len(noise)) * 0.3
+        vowel = np.concatenate((noise, vowel))
+    return vowel
+
+
+def synthetic_speech(duration=60, seed=0, frame_rate=44100, channels=2):
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(int(duration * frame_rate))
+    i = int(rng.uniform(0.3, 1.0) * frame_rate)
+    while i < len(samples) - 2 * frame_rate:
+        end = min(i + int(rng.uniform(1.5, 12) * frame_rate),
+                  len(samples) - frame_rate // 2)
+        f0 = rng.uniform(100, 220)
+        while i < end:
+            s = syllable(rng, f0, frame_rate)[:end - i]
+            samples[i:i + len(s)] = 0.5 * s
+            i += len(s) + int(rng.uniform(0, 0.05) * frame_rate)
+        i += int(rng.uniform(0.4, 1.2) * frame_rate)
+    samples += 0.002 * rng.standard_normal(len(samples))
+    pcm = (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+    return AudioSegment(data=np.repeat(pcm, channels).tobytes(),
+                        sample_width=2, frame_rate=frame_rate,
+                        channels=channels)
+
+
+class LoopbackStream:
+
+    def __init__(self, rate, channels, frames_per_buffer, stream_callback,
+                 delay=1000, realtime=False, **kwargs):
+        self._rate = rate
+        self._channels = channels
+        self._frames_per_buffer = frames_per_buffer
+        self._callback = stream_callback
+        self._delay = delay
+        self._realtime = realtime
+        # Output is fed back to the input after `delay` frames.
+        self._buffer = bytearray(delay * 2 * channels)
+        self._thread = None
+        self._active = False
+
+    def _run(self):
+        size = self._frames_per_buffer * 2 * self._channels
+        while self._active:
+            in_data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            out_data, _ = self._callback(
+                in_data, self._frames_per_buffer, {}, 0)
+            self._buffer += out_data
+            time.sleep(self._frames_per_buffer /
+                       self._rate if self._realtime else 0)
+
+    def start_stream(self):
+        self._active = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop_stream(self):
+        self._active = False
+        self._thread.join()
+
+    def close(self):
+        pass
+
+    def is_active(self):
+        return self._active
+
+    def get_input_latency(self):
+        return self._delay * 0.6 / self._rate
+
+    def get_output_latency(self):
+        return self._delay * 0.4 / self._rate
+
+
+class Loopback:
+
+    paInt16 = 8
+    paContinue = 0
+
+    def __init__(self, delay=1000, realtime=False):
+        self._delay = delay
+        self._realtime = realtime
+
+    def PyAudio(self):
+        return self
+
+    def open(self, **kwargs):
+        return LoopbackStream(delay=self._delay, realtime=self._realtime,
+                              **kwargs)
+
+    def terminate(self):
+        pass
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summary(times, audio_seconds=None, latencies=None):
+    result = {
+        "runs": len(times),
+        "seconds": float(np.median(times)),
+        "min": float(np.min(times)),
+        "max": float(np.max(times)),
+    }
+    if audio_seconds:
+        result["audio_seconds"] = audio_seconds
+        result["realtime_factor"] = audio_seconds / result["seconds"]
+    if latencies is not None:
+        result["latency"] = {"p50": percentile(latencies, 50),
+                             "p95": percentile(latencies, 95),
+                             "max": float(np.max(latencies))}
+    return result
+
+
+class Unavailable(Exception):
+    pass
+
+
+def load(model):
+    # A model that cannot be loaded here (offline, missing package) skips
+    # the stages using it, any other failure is an error.
+    try:
+        return model()
+    except Exception as e:
+        raise Unavailable("{}: {}".format(type(e).__name__, e)) from e
+
+
+class Benchmark:
+
+    def __init__(self, duration=60, seed=0, repeat=3, phrases=8,
+                 directory=None, models=None, tracer=None, runtime=None):
+        self._duration = duration
+        self._seed = seed
+        self._repeat = repeat
+        self._phrases = phrases
+        self._directory = directory
+        self._models = models if models is not None else ModelRegistry()
+        self._tracer = tracer
+        self._runtime = runtime if runtime is not None else RuntimeConfig()
+        self._results = {}
+        self._tmp = None
+        self._stores = 0
+        self._chunker = None
+        self._formatter = None
+
+    @property
+    def results(self):
+        return dict(self._results)
+
+    @property
+    def backend(self):
+        return self._runtime.backend
+
+    def run(self, stages=None):
+        self._results = {}
+        cleanup = self._directory is None
+        directory = self._directory or tempfile.mkdtemp(prefix="echomaster-")
+        try:
+            self._setup(directory)
+            for name in stages or self.STAGES:
+                try:
+                    self._results[name] = getattr(self, "_" + name)()
+                except Unavailable as e:
+                    self._results[name] = {"skipped": str(e)}
+                except Exception as e:
+                    self._results[name] = {
+                        "error": "{}: {}".format(type(e).__name__, e)}
+        finally:
+            if self._formatter is not None:
+                self._formatter.close()
+            if cleanup:
+                shutil.rmtree(directory, ignore_errors=True)
+        return self.results
+
+    def _setup(self, directory):
+        self._tmp = directory
+        self._source = os.path.join(directory, "synthetic.wav")
+        synthetic_speech(self._duration, self._seed).export(
+            self._source, format="wav")
+        self._chunker = SpeechChunker(
+            cache=AudioCache(os.path.join(directory, "cache")),
+            models=self._models, runtime=self._runtime, tracer=self._tracer)
+        self._chunker.url = self._source
+        self._chunker.download()
+        self._formatter = self._shadow_formatter()
+        # The per-phrase stages need phrases even when process is not run.
+        self._segmented = None
+        try:
+            load(lambda: self._chunker.model)
+        except Unavailable as e:
+            self._segmented = e
+        else:
+            self._chunker.process()
+
+    def _shadow_formatter(self):
+        return ShadowFormatter(self._chunker, models=self._models,
+                               store=self._store(), runtime=self._runtime,
+                               tracer=self._tracer)
+
+    def _store(self):
+        self._stores += 1
+        return SubtitleStore(os.path.join(
+            self._tmp, "subtitles-{}.sqlite".format(self._stores)))
+
+    def _sample(self):
+        if self._segmented is not None:
+            raise self._segmented
+        phrases = self._chunker.phrases
+        if not phrases:
+            raise RuntimeError("No phrases were segmented")
+        return list(range(min(self._phrases, len(phrases))))
+
+    def _audio_seconds(self, indexes):
+        return sum(end - start for start, end in
+                   (self._chunker.phrases[i] for i in indexes)) / 1000
+
+    def _decode(self):
+        path = os.path.join(self._tmp, "decoded.f32")
+        times = timed(lambda: decode(self._source, path, 2), self._repeat)
+        result = summary(times, self._duration)
+        # The same analysis audio through a full-rate decode and torchaudio.
+        times = timed(lambda: waveform(AudioSegment.from_file(self._source)),
+                      self._repeat)
+        result["full_rate"] = summary(times, self._duration)
+        return result
+
+    def _process(self):
+        vad = os.path.join(self._chunker._entry, "vad.npz")
+
+        def process():
+            if os.path.isfile(vad):
+                os.remove(vad)
+            self._chunker.process()
+        # Load the model outside of the timed runs.
+        load(lambda: self._chunker.model)
+        times = timed(process, self._repeat)
+        result = summary(times, self._duration)
+        result["phrases"] = len(self._chunker.phrases)
+        return result
+
+    def _segment(self):
+        load(lambda: self._chunker.model)
+        times = timed(self._chunker.segment, self._repeat)
+        return summary(times, self._duration)
+
+    def _subtitle(self):
+        indexes = self._sample()
+        load(lambda: self._formatter.model)
+        latencies = []
+
+        def subtitle():
+            for i in indexes:
+                start = time.perf_counter()
+                self._formatter.subtitle(
+                    self._chunker.slice(*self._chunker.phrases[i]))
+                latencies.append(time.perf_counter() - start)
+        times = timed(subtitle, self._repeat)
+        return summary(times, self._audio_seconds(indexes), latencies)
+
+    def _format(self):
+        indexes = self._sample()
+        load(lambda: self._formatter.model)
+        latencies = []
+
+        def format():
+            # A fresh store each run so every phrase is transcribed.
+            formatter = self._shadow_formatter()
+            self._chunker.reset()
+            for _ in indexes:
+                start = time.perf_counter()
+                formatter.format()
+                latencies.append(time.perf_counter() - start)
+        times = timed(format, self._repeat)
+        return summary(times, self._audio_seconds(indexes), latencies)
+
+    def _transcribe(self):
+        load(lambda: self._formatter.model)
+
+        def transcribe():
+            self._shadow_formatter().transcribe()
+        times = timed(transcribe, self._repeat)
+        return summary(times, self._audio_seconds(
+            range(len(self._chunker.phrases))))
+
+    def _compare(self):
+        indexes = self._sample()
+        comparator = SpeechComparator(
+            models=self._models, runtime=self._runtime, tracer=self._tracer,
+            directory=os.path.join(self._tmp, "features"))
+        load(lambda: comparator.model)
+        rng = np.random.default_rng(self._seed)
+        attempts = []
+        for i in indexes:
+            # Scored like the live loop: the shadow and a capture aligned
+            # with it.
+            reference = Shadow(self._chunker.phrase(i)).segment()
+            noise = (rng.standard_normal(int(
+                reference.frame_count())) * 300).astype(np.int16)
+            attempts.append((reference, reference.overlay(AudioSegment(
+                data=np.repeat(noise, reference.channels).tobytes(),
+                sample_width=2, frame_rate=reference.frame_rate,
+                channels=reference.channels)), self._chunker.phrases[i]))
+        result = {}
+        for name, keyed in (("cold", False), ("cached", True)):
+            latencies = []
+
+            def compare():
+                for reference, attempt, bounds in attempts:
+                    start = time.perf_counter()
+                    comparator.compare(reference, attempt, key=(
+                        self._chunker.digest,) + tuple(bounds)
+                        if keyed else None)
+                    latencies.append(time.perf_counter() - start)
+            times = timed(compare, self._repeat)
+            result[name] = summary(
+                times, self._audio_seconds(indexes), latencies)
+        return dict(result["cold"], cached=result["cached"])
+
+    def _dtw(self):
+        rng = np.random.default_rng(self._seed)
+        # Five seconds of 1024-dimensional wav2vec2 frames.
+        x = rng.standard_normal((250, 1024)).astype(np.float32)
+        y = rng.standard_normal((250, 1024)).astype(np.float32)
+        times = timed(lambda: dtw(x, y, 25), self._repeat)
+        return summary(times)
+
+    def _audio_io(self):
+        indexes = self._sample()
+        latencies = []
+        with AudioEngine(backend=Loopback(), tracer=self._tracer) as engine:
+            def play():
+                for i in indexes:
+                    start = time.perf_counter()
+                    engine.play(Shadow(self._chunker.phrase(i)))
+                    latencies.append(time.perf_counter() - start)
+            times = timed(play, self._repeat)
+            xruns = engine.xruns
+        # Shadows play the phrase, then a pause of the same length.
+        result = summary(times, 2 * self._audio_seconds(indexes), latencies)
+        result["xruns"] = sum(xruns.values())
+        return result
+
+    def _export(self):
+        path = os.path.join(self._tmp, "shadow.wav")
+        times = timed(lambda: self._formatter.export(path), self._repeat)
+        with wave.open(path) as f:
+            return summary(times, f.getnframes() / f.getframerate())
+
+    STAGES = ("decode", "process", "segment", "subtitle", "format",
+              "transcribe", "compare", "dtw", "audio_io", "export")
+
+
+def regressions(results, baseline, threshold=0.2):
+    # Stages timed in the baseline regress when they are slower, or when
+    # they were skipped, failed or not run at all.
+    found = {}
+    stages = results.get("stages", {})
+    for name, reference in baseline.get("stages", {}).items():
+        if "seconds" not in reference:
+            continue
+        result = stages.get(name)
+        if result is None:
+            found[name] = "missing"
+        elif "seconds" not in result:
+            found[name] = "skipped: " + result["skipped"] \
+                if "skipped" in result else "error: " + result["error"]
+        elif result["seconds"] / reference["seconds"] > 1 + threshold:
+            found[name] = result["seconds"] / reference["seconds"]
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark every stage of the pipeline offline.")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Length of the synthetic track in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--phrases", type=int, default=8,
+                        help="Phrases used by the per-phrase stages")
+    parser.add_argument("--stages", nargs="+", choices=Benchmark.STAGES)
+    parser.add_argument("--models", help="Local model directory")
+    parser.add_argument("--backend", choices=("torch", "onnx"),
+                        default="torch", help="Inference backend")
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--trace", help="Write every span to this JSON-lines file")
+    parser.add_argument("--baseline", help="Results of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    import torch
+    sink = JsonLinesSink(args.trace) if args.trace else None
+    benchmark = Benchmark(args.duration, args.seed, args.repeat,
+                          args.phrases, models=ModelRegistry(args.models),
+                          tracer=Tracer(sink) if sink else None,
+                          runtime=RuntimeConfig(backend=args.backend))
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+        },
+        "parameters": {"duration": args.duration, "seed": args.seed,
+                       "repeat": args.repeat, "phrases": args.phrases,
+                       "backend": benchmark.backend},
+        "stages": benchmark.run(args.stages),
+    }
+    if sink is not None:
+        sink.close()
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    failed = [name for name, result in results["stages"].items()
+              if "error" in result]
+    for name in failed:
+        print("Stage {} failed: {}".format(
+            name, results["stages"][name]["error"]), file=sys.stderr)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.threshold)
+        for name, ratio in sorted(found.items()):
+            if isinstance(ratio, str):
+                print("Regression in {}: {}".format(name, ratio),
+                      file=sys.stderr)
+            else:
+                print("Regression in {}: {:.2f}x slower than the "
+                      "baseline".format(name, ratio), file=sys.stderr)
+        if found:
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import concurrent.futures
+import threading
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, name, lane, dispatch, on_done=None, on_error=None,
+                 on_progress=None):
+        self._name = name
+        self._lane = lane
+        self._dispatch = dispatch
+        self._on_done = on_done
+        self._on_error = on_error
+        self._on_progress = on_progress
+        self._cancel = threading.Event()
+        self._future = None
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def lane(self):
+        return self._lane
+
+    @property
+    def future(self):
+        return self._future
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+        if self._future is not None:
+            self._future.cancel()
+
+    def check(self):
+        if self._cancel.is_set():
+            raise Cancelled(self._name)
+
+    def progress(self, *args):
+        # Also a cancellation point for the job's function.
+        self.check()
+        if self._on_progress is not None:
+            self._dispatch(self._deliver, self._on_progress, args)
+
+    def result(self, timeout=None):
+        return self._future.result(timeout)
+
+    def _deliver(self, callback, args):
+        # Runs on the UI thread: a job cancelled in the meantime reports
+        # nothing.
+        if not self._cancel.is_set():
+            callback(*args)
+
+    def _done(self, future):
+        if self._cancel.is_set() or future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            if self._on_done is not None:
+                self._dispatch(self._deliver, self._on_done,
+                               (future.result(),))
+        elif isinstance(error, Cancelled):
+            return
+        elif self._on_error is not None:
+            self._dispatch(self._deliver, self._on_error, (error,))
+
+
+def call(function, *args):
+    function(*args)
+
+
+class JobScheduler:
+
+    def __init__(self, dispatch=None, workers=2):
+        # dispatch(function, *args) must run function on the UI thread,
+        # by default callbacks run on the worker.
+        self._dispatch = dispatch if dispatch is not None else call
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._lanes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, name, function, *args, lane=None, supersede=True,
+               on_done=None, on_error=None, on_progress=None, **kwargs):
+        # function(job, *args, **kwargs) runs on a worker thread. Jobs of a
+        # lane run one after the other, and a job supersedes the unfinished
+        # ones of the same name.
+        lane = name if lane is None else lane
+        job = Job(name, lane, self._dispatch, on_done, on_error, on_progress)
+        with self._lock:
+            previous = self._lanes.get(lane, [])
+            if supersede:
+                for i in previous:
+                    if i.name == name:
+                        i.cancel()
+            previous = [i for i in previous if not i.future.done()]
+            job._future = self._executor.submit(
+                self._run, job, previous, function, args, kwargs)
+            self._lanes[lane] = previous + [job]
+        job._future.add_done_callback(job._done)
+        job._future.add_done_callback(
+            lambda future: self._finished(job))
+        return job
+
+    def _run(self, job, previous, function, args, kwargs):
+        for i in previous:
+            try:
+                # Cancelled futures that never started have nothing to wait
+                # for.
+                i.future.exception()
+            except concurrent.futures.CancelledError:
+                pass
+        job.check()
+        return function(job, *args, **kwargs)
+
+    def _finished(self, job):
+        with self._lock:
+            jobs = self._lanes.get(job.lane, [])
+            if job in jobs:
+                jobs.remove(job)
+            if not jobs:
+                self._lanes.pop(job.lane, None)
+
+    def cancel(self, lane=None):
+        with self._lock:
+            lanes = list(self._lanes) if lane is None else [lane]
+            jobs = [i for name in lanes for i in self._lanes.get(name, [])]
+        for job in jobs:
+            job.cancel()
+
+    def busy(self, lane=None):
+        with self._lock:
+            if lane is None:
+                return bool(self._lanes)
+            return bool(self._lanes.get(lane))
+
+    def close(self, wait=True):
+        self.cancel()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
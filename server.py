@@ -0,0 +1,419 @@
+import argparse
+import concurrent.futures
+import http.client
+import http.server
+import io
+import json
+import math
+import os
+import queue
+import re
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+from pydub import AudioSegment
+
+from speech_chunker import (NullTracer, RuntimeConfig, ShadowFormatter,
+                            SpeechComparator, SubtitleStore, waveform)
+
+
+class DynamicBatcher:
+
+    _CLOSE = object()
+
+    def __init__(self, function, max_batch_size=16, max_wait=0.01,
+                 name="batch", tracer=None):
+        # function(items) returns one result per item. Items submitted while
+        # the first one of a batch waits at most max_wait seconds join it.
+        self._function = function
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._name = name
+        self._tracer = tracer if tracer is not None else NullTracer()
+        self._queue = queue.Queue()
+        self._batches = 0
+        self._items = 0
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    @property
+    def stats(self):
+        return {"batches": self._batches, "items": self._items}
+
+    def submit(self, item):
+        future = concurrent.futures.Future()
+        self._queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is self._CLOSE:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self._max_wait
+        while len(batch) < self._max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if entry is self._CLOSE:
+                self._queue.put(entry)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while (batch := self._collect()) is not None:
+            batch = [(item, future) for item, future in batch
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            self._batches += 1
+            self._items += len(batch)
+            try:
+                with self._tracer.span(self._name, size=len(batch)):
+                    results = self._function([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                # A failed item only fails its own request.
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def close(self):
+        self._queue.put(self._CLOSE)
+        self._worker.join()
+
+
+def pack(**arrays):
+    f = io.BytesIO()
+    np.savez(f, **arrays)
+    return f.getvalue()
+
+
+def unpack(data):
+    with np.load(io.BytesIO(data)) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def parse_key(header):
+    # Keys name files of the feature store: a hex digest and the bounds of
+    # the phrase.
+    if not header:
+        return None
+    try:
+        key = json.loads(header)
+    except ValueError:
+        key = None
+    if not isinstance(key, list) or len(key) != 3 or \
+            not isinstance(key[0], str) or \
+            not re.fullmatch(r"[0-9a-f]{1,128}", key[0]) or \
+            not all(isinstance(i, (int, float)) and
+                    not isinstance(i, bool) and math.isfinite(i)
+                    for i in key[1:]):
+        raise ValueError("Invalid X-Key " + header)
+    return (key[0], float(key[1]), float(key[2]))
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/info":
+            self.reply(404, {"error": "Unknown path " + self.path})
+            return
+        self.reply(200, self.server.inference.info())
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        inference = self.server.inference
+        try:
+            if self.path == "/subtitle":
+                arrays = unpack(data)
+                texts = inference.subtitle(
+                    [arrays[str(i)] for i in range(len(arrays))])
+                self.reply(200, {"texts": texts})
+            elif self.path == "/compare":
+                try:
+                    key = parse_key(self.headers.get("X-Key"))
+                except ValueError as e:
+                    self.reply(400, {"error": str(e)})
+                    return
+                arrays = unpack(data)
+                score = inference.compare(
+                    arrays["reference"], arrays["audio"], key)
+                self.reply(200, {"score": score})
+            else:
+                self.reply(404, {"error": "Unknown path " + self.path})
+        except Exception as e:
+            self.reply(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+
+    def __init__(self, address=("127.0.0.1", 8765), formatter=None,
+                 comparator=None, max_batch_size=16, max_wait=0.01,
+                 models=None, runtime=None, tracer=None):
+        # address is a (host, port) pair or the path of a Unix socket. The
+        # models are loaded once and shared by every client.
+        self._runtime = runtime if runtime is not None else RuntimeConfig()
+        self._tracer = tracer if tracer is not None else NullTracer()
+        self._formatter = formatter if formatter is not None \
+            else ShadowFormatter(None, store=SubtitleStore(":memory:"),
+                                 models=models, runtime=self._runtime)
+        self._comparator = comparator if comparator is not None \
+            else SpeechComparator(models=models, runtime=self._runtime)
+        self._subtitles = DynamicBatcher(
+            self._formatter.recognize, max_batch_size, max_wait,
+            "subtitle_batch", self._tracer)
+        self._scores = DynamicBatcher(
+            self._compare, max_batch_size, max_wait, "compare_batch",
+            self._tracer)
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            self._server = UnixHTTPServer(address, Handler)
+        else:
+            self._server = http.server.ThreadingHTTPServer(address, Handler)
+        self._server.inference = self
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def address(self):
+        return self._server.server_address
+
+    def info(self):
+        return {"stt": self._formatter._model_name,
+                "comparator": self._comparator._model_name,
+                "layer": self._comparator.layer,
+                "subtitle": self._subtitles.stats,
+                "compare": self._scores.stats}
+
+    def subtitle(self, audios):
+        import torch
+        futures = [self._subtitles.submit(torch.from_numpy(i))
+                   for i in audios]
+        return [i.result() for i in futures]
+
+    def compare(self, reference, audio, key=None):
+        import torch
+        return self._scores(
+            (torch.from_numpy(reference), torch.from_numpy(audio), key))
+
+    def _compare(self, items):
+        try:
+            return self._compare_batch(items)
+        except Exception:
+            if len(items) == 1:
+                raise
+        # Retried one by one so that a bad item fails only its request.
+        results = []
+        for item in items:
+            try:
+                results += self._compare_batch([item])
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _compare_batch(self, items):
+        comparator = self._comparator
+        references = [None if key is None else comparator.cached(key)
+                      for _, _, key in items]
+        missing = [i for i, features in enumerate(references)
+                   if features is None]
+        # Missing references and every attempt go through the model
+        # together.
+        features = comparator.extract_batch(
+            [items[i][0] for i in missing] + [audio for _, audio, _ in items])
+        for i, feature in zip(missing, features):
+            references[i] = feature
+            if items[i][2] is not None:
+                comparator.remember(items[i][2], feature)
+        return [comparator.score(reference, audio) for reference, audio
+                in zip(references, features[len(missing):])]
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        self._subtitles.close()
+        self._scores.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class InferenceClient:
+
+    def __init__(self, address=("127.0.0.1", 8765), timeout=60):
+        self._address = address
+        self._timeout = timeout
+        self._local = threading.local()
+        self._info = None
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            if isinstance(self._address, str):
+                connection = UnixHTTPConnection(self._address, self._timeout)
+            else:
+                connection = http.client.HTTPConnection(
+                    *self._address, timeout=self._timeout)
+            self._local.connection = connection
+        return connection
+
+    def request(self, method, path, body=None, headers=None):
+        # Each thread keeps its own connection open.
+        connection = self._connection()
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            data = json.loads(response.read())
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.status != 200:
+            raise RuntimeError(data.get("error", response.reason))
+        return data
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = self.request("GET", "/info")
+        return self._info
+
+    def recognize(self, audios):
+        body = pack(**{str(i): np.asarray(audio, dtype=np.float32)
+                       for i, audio in enumerate(audios)})
+        return self.request("POST", "/subtitle", body)["texts"]
+
+    def score(self, reference, audio, key=None):
+        headers = {} if key is None else {"X-Key": json.dumps(list(key))}
+        body = pack(reference=np.asarray(reference, dtype=np.float32),
+                    audio=np.asarray(audio, dtype=np.float32))
+        return self.request("POST", "/compare", body, headers)["score"]
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+
+class RemoteFormatter(ShadowFormatter):
+
+    def __init__(self, speech_chunker, client, **kwargs):
+        super().__init__(speech_chunker, **kwargs)
+        self._client = client
+        # Stored subtitles are shared with the in-process formatter running
+        # the same model.
+        self._model_name = client.info["stt"]
+
+    def recognize(self, audios):
+        return self._client.recognize(audios)
+
+
+class RemoteComparator(SpeechComparator):
+
+    def __init__(self, client, tracer=None):
+        super().__init__(tracer=tracer)
+        self._client = client
+
+    def _compare(self, reference, audio, key=None):
+        reference, audio = self.preprocess(reference, audio)
+        if isinstance(reference, AudioSegment):
+            reference = waveform(reference)
+        if isinstance(audio, AudioSegment):
+            audio = waveform(audio)
+        return self._client.score(reference, audio, key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Serve speech to text and scoring to local sessions.")
+    parser.add_argument("--socket", help="Listen on this Unix socket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait", type=float, default=10,
+                        help="Milliseconds a request waits for others")
+    parser.add_argument("--threads", type=int, help="torch threads")
+    parser.add_argument("--backend", choices=("torch", "onnx"),
+                        default="torch", help="Inference backend")
+    args = parser.parse_args(argv)
+
+    address = args.socket if args.socket else (args.host, args.port)
+    server = InferenceServer(
+        address, max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait / 1000,
+        runtime=RuntimeConfig(threads=args.threads, backend=args.backend))
+    print("Listening on {}".format(server.address), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
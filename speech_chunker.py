@@ -1,39 +1,1244 @@
-import yt_dlp
-from fastdtw import fastdtw
 import time
 import threading
-import torch
-import torchaudio
-import requests
-import pyaudio
+import queue
+import concurrent.futures
 import os
+import sys
+import subprocess
+import re
+import shutil
+import tempfile
+import hashlib
+import urllib.parse
+import functools
+import sqlite3
+import collections
+import math
+import difflib
+import wave
+import json
+import importlib.util
+import warnings
 import numpy as np
 from pydub import AudioSegment
-from pydub.silence import detect_nonsilent
-from pydub import AudioSegment
-import speech_recognition as sr
-import scipy
+
+# torch, torchaudio, yt_dlp, pyaudio and fastdtw are imported where they are
+# used so that importing this module stays fast.
+
+
+@functools.lru_cache(maxsize=None)
+def resampler(orig_freq, new_freq=16000):
+    import torchaudio
+    return torchaudio.transforms.Resample(
+        orig_freq=orig_freq, new_freq=new_freq)
+
+
+def waveform(segment, sampling_rate=16000):
+    import torch
+    audio = np.frombuffer(segment.raw_data, np.int16)
+    audio = audio.reshape(
+        len(audio) //
+        segment.channels,
+        segment.channels).mean(
+        axis=1, dtype=np.float32)
+    audio = torch.from_numpy(audio / np.float32(32767.5))
+    if segment.frame_rate != sampling_rate:
+        audio = resampler(segment.frame_rate, sampling_rate)(
+            audio.unsqueeze(0)).squeeze(0)
+    return audio
+
+
+class MappedAudio:
+
+    def __init__(self, path):
+        with wave.open(path, "rb") as f:
+            self._channels = f.getnchannels()
+            self._sample_width = f.getsampwidth()
+            self._frame_rate = f.getframerate()
+        if self._sample_width != 2:
+            raise ValueError("Only 16-bit PCM is supported")
+        offset, size = self._data_chunk(path)
+        size = min(size, os.path.getsize(path) - offset)
+        self._path = path
+        self._samples = np.memmap(
+            path, np.int16, "r", offset=offset,
+            shape=(size // (2 * self._channels), self._channels))
+
+    @staticmethod
+    def _data_chunk(path):
+        with open(path, "rb") as f:
+            header = f.read(12)
+            if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+                raise ValueError("{} is not a WAV file".format(path))
+            while len(header := f.read(8)) == 8:
+                size = int.from_bytes(header[4:], "little")
+                if header[:4] == b"data":
+                    return f.tell(), size
+                f.seek(size + (size & 1), 1)
+        raise ValueError("{} has no data chunk".format(path))
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def sample_width(self):
+        return self._sample_width
+
+    @property
+    def frame_rate(self):
+        return self._frame_rate
+
+    @property
+    def frame_count(self):
+        return len(self._samples)
+
+    def __len__(self):
+        return round(1000 * len(self._samples) / self._frame_rate)
+
+    def frames(self, start, end):
+        # Frames of self[start:end], without reading them.
+        count = len(self._samples)
+        return max(min(int(end * self._frame_rate / 1000), count) -
+                   min(int(start * self._frame_rate / 1000), count), 0)
+
+    def __getitem__(self, key):
+        start = 0 if key.start is None else int(
+            key.start * self._frame_rate / 1000)
+        end = len(self._samples) if key.stop is None else int(
+            key.stop * self._frame_rate / 1000)
+        # Only the pages backing the slice are read.
+        return AudioSegment(
+            data=self._samples[start:end].tobytes(),
+            sample_width=self._sample_width,
+            frame_rate=self._frame_rate,
+            channels=self._channels)
+
+    def resample(self, path, sampling_rate=16000, block_duration=30):
+        import torch
+        if not os.path.isfile(path):
+            gcd = math.gcd(self._frame_rate, sampling_rate)
+            step_in, step_out = self._frame_rate // gcd, sampling_rate // gcd
+            block = step_in * max(1, block_duration *
+                                  self._frame_rate // step_in)
+            # Enough context on each side of a block for the resampling
+            # kernel, so blocks join without seams.
+            context = step_in * (1024 // step_in + 2)
+            length = math.ceil(len(self._samples) * step_out / step_in)
+            resample = resampler(self._frame_rate, sampling_rate)
+            tmp = path + ".{}.tmp".format(os.getpid())
+            with open(tmp, "wb") as f:
+                written = 0
+                for start in range(0, len(self._samples), block):
+                    first = max(0, start - context)
+                    audio = self._samples[first:start + block + context].mean(
+                        axis=1, dtype=np.float32) / np.float32(32767.5)
+                    audio = resample(torch.from_numpy(audio).unsqueeze(0))[0]
+                    skip = (start - first) // step_in * step_out
+                    keep = min(block // step_in * step_out, length - written)
+                    f.write(audio[skip:skip + keep].numpy().tobytes())
+                    written += keep
+            os.replace(tmp, path)
+        return mapped(path)
+
+
+def mapped(path):
+    import torch
+    if os.path.getsize(path) == 0:
+        return torch.zeros(0)
+    return torch.from_numpy(np.memmap(path, np.float32, "c"))
+
+
+def decode(source, path, channels, sampling_rate=16000, block_size=1 << 16):
+    # A single ffmpeg pass straight to float32 at the analysis rate.
+    # Channels are averaged here like waveform() does, ffmpeg's own downmix
+    # uses different levels.
+    tmp = path + ".{}.tmp".format(os.getpid())
+    process = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-i", source, "-vn",
+         "-f", "f32le", "-ar", str(sampling_rate), "pipe:1"],
+        stdout=subprocess.PIPE)
+    frame = 4 * channels
+    try:
+        with open(tmp, "wb") as f:
+            pending = b""
+            while block := process.stdout.read(block_size * frame):
+                block = pending + block
+                end = len(block) - len(block) % frame
+                pending = block[end:]
+                f.write(np.frombuffer(block[:end], np.float32).reshape(
+                    -1, channels).mean(axis=1, dtype=np.float32).tobytes())
+        if process.wait() != 0:
+            raise RuntimeError("ffmpeg failed to decode {}".format(source))
+        os.replace(tmp, path)
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+class SourceAudio:
+
+    def __init__(self, path):
+        from pydub.utils import mediainfo_json
+        info = mediainfo_json(path)
+        stream = next(i for i in info["streams"]
+                      if i.get("codec_type") == "audio")
+        self._path = path
+        self._channels = int(stream["channels"])
+        self._frame_rate = int(stream["sample_rate"])
+        self._duration = float(
+            stream.get("duration") or info["format"].get("duration") or 0)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def sample_width(self):
+        return 2
+
+    @property
+    def frame_rate(self):
+        return self._frame_rate
+
+    @property
+    def frame_count(self):
+        return round(self._duration * self._frame_rate)
+
+    def __len__(self):
+        return round(1000 * self._duration)
+
+    def frames(self, start, end):
+        # Frames ffmpeg decodes for self[start:end], without decoding them.
+        return max(min(round((end - start) * self._frame_rate / 1000),
+                       self.frame_count - round(
+                           start * self._frame_rate / 1000)), 0)
+
+    def __getitem__(self, key):
+        # Only the requested range is decoded, at the source's own rate.
+        start = 0 if key.start is None else key.start
+        command = ["ffmpeg", "-loglevel", "error", "-ss",
+                   "{:.6f}".format(start / 1000), "-i", self._path, "-vn"]
+        if key.stop is not None:
+            command += ["-t", "{:.6f}".format(max(key.stop - start, 0) / 1000)]
+        data = subprocess.run(
+            command + ["-f", "s16le", "-ac", str(self._channels),
+                       "-ar", str(self._frame_rate), "pipe:1"],
+            stdout=subprocess.PIPE, check=True).stdout
+        return AudioSegment(data=data, sample_width=2,
+                            frame_rate=self._frame_rate,
+                            channels=self._channels)
+
+
+def cache_directory():
+    return os.environ.get(
+        "ECHOMASTER_CACHE", os.path.join(
+            os.path.expanduser("~"), ".cache", "echomaster"))
+
+
+class AudioCache:
+
+    def __init__(self, directory=None, max_size=2 * 1024**3):
+        if directory is None:
+            # Features, ONNX exports and subtitles are kept next to it, out
+            # of its eviction.
+            directory = os.path.join(cache_directory(), "audio")
+        self._directory = directory
+        self._max_size = max_size
+        os.makedirs(self._directory, exist_ok=True)
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size):
+        self._max_size = max_size
+        self.evict()
+
+    @staticmethod
+    def key(url):
+        parsed = urllib.parse.urlparse(url)
+        video_id = urllib.parse.parse_qs(parsed.query).get("v", [None])[0]
+        if video_id is None and parsed.netloc.endswith("youtu.be"):
+            video_id = parsed.path.lstrip("/")
+        if video_id and re.fullmatch(r"[A-Za-z0-9_-]+", video_id):
+            return video_id
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def get(self, key):
+        entry = os.path.join(self._directory, key)
+        # Entry mtime is the LRU clock. Entries are published whole, see
+        # put(), but can be evicted by another process at any time.
+        now = time.time_ns()
+        try:
+            os.utime(entry, ns=(now, now))
+        except FileNotFoundError:
+            return None
+        return entry if os.path.isdir(entry) else None
+
+    def lease(self, entry):
+        # A shared lock held while the entry is in use, evict() skips
+        # entries it cannot lock exclusively. Returns None if the entry was
+        # evicted.
+        path = os.path.join(entry, ".lock")
+        try:
+            lock = open(path, "a")
+        except FileNotFoundError:
+            return None
+        try:
+            import fcntl
+        except ImportError:
+            return lock
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        # evict() moves entries away before deleting them.
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+        return None
+
+    def _remove(self, entry):
+        try:
+            lock = open(os.path.join(entry, ".lock"), "a")
+        except FileNotFoundError:
+            return True
+        with lock:
+            try:
+                import fcntl
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except ImportError:
+                pass
+            except BlockingIOError:
+                return False
+            trash = tempfile.mkdtemp(prefix=".evicted-", dir=self._directory)
+            try:
+                os.rename(entry, os.path.join(trash, "entry"))
+            except FileNotFoundError:
+                return True
+            finally:
+                shutil.rmtree(trash, ignore_errors=True)
+        return True
+
+    def put(self, key, build):
+        # Build in a private directory so concurrent loads never share a
+        # path, then publish atomically.
+        tmp = tempfile.mkdtemp(prefix=".{}-".format(key), dir=self._directory)
+        try:
+            build(tmp)
+            try:
+                os.rename(tmp, os.path.join(self._directory, key))
+            except OSError:
+                shutil.rmtree(tmp)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        entry = self.get(key)
+        self.evict(keep=key)
+        return entry
+
+    def digest(self, entry):
+        path = os.path.join(entry, "digest")
+        if os.path.isfile(path):
+            with open(path) as f:
+                return f.read()
+        digest = hashlib.sha1()
+        audio = os.path.join(entry, "audio.wav")
+        if not os.path.isfile(audio):
+            audio = os.path.join(entry, "audio16k.f32")
+        with open(audio, "rb") as f:
+            for block in iter(functools.partial(f.read, 1 << 20), b""):
+                digest.update(block)
+        digest = digest.hexdigest()
+        tmp = path + ".{}.tmp".format(os.getpid())
+        with open(tmp, "w") as f:
+            f.write(digest)
+        os.replace(tmp, path)
+        return digest
+
+    @staticmethod
+    def entry(path):
+        return any(os.path.isfile(os.path.join(path, i)) for i in (
+            "audio.wav", "audio16k.f32"))
+
+    def size(self, entry):
+        return sum(os.path.getsize(os.path.join(entry, i))
+                   for i in os.listdir(entry))
+
+    def evict(self, keep=None):
+        entries = [os.path.join(self._directory, i) for i in os.listdir(
+            self._directory) if not i.startswith(".") and i != keep and
+            self.entry(os.path.join(self._directory, i))]
+        if keep is not None:
+            entries.append(os.path.join(self._directory, keep))
+        # Other processes evict from the same directory.
+        sizes, mtimes = {}, {}
+        for entry in entries:
+            try:
+                mtimes[entry] = os.path.getmtime(entry)
+                sizes[entry] = self.size(entry)
+            except (FileNotFoundError, NotADirectoryError):
+                mtimes.pop(entry, None)
+        total = sum(sizes.values())
+        if keep is not None:
+            sizes.pop(os.path.join(self._directory, keep), None)
+        for entry in sorted(sizes, key=mtimes.get):
+            if total <= self._max_size:
+                break
+            # Entries in use are kept.
+            if self._remove(entry):
+                total -= sizes[entry]
+
+    def clear(self):
+        for i in os.listdir(self._directory):
+            shutil.rmtree(os.path.join(self._directory, i), ignore_errors=True)
+
+
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Span:
+
+    def __init__(self, tracer, name, fields):
+        self._tracer = tracer
+        self._name = name
+        self._fields = fields
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is not None:
+            self._fields["error"] = kind.__name__
+        self._tracer.emit(
+            self._name, time.perf_counter() - self._start, **self._fields)
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+
+
+class NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        pass
+
+    def __setitem__(self, key, value):
+        pass
+
+
+class Tracer:
+
+    def __init__(self, callback=None, window=1024):
+        self._callback = callback
+        self._window = window
+        self._lock = threading.Lock()
+        self._durations = {}
+
+    @property
+    def enabled(self):
+        return True
+
+    @property
+    def callback(self):
+        return self._callback
+
+    @callback.setter
+    def callback(self, callback):
+        self._callback = callback
+
+    def span(self, name, **fields):
+        return Span(self, name, fields)
+
+    def emit(self, name, duration, **fields):
+        with self._lock:
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = collections.deque(
+                    maxlen=self._window)
+            durations.append(duration)
+        if self._callback is not None:
+            event = {"name": name, "time": time.time(), "duration": duration,
+                     "thread": threading.current_thread().name,
+                     "peak_memory": peak_memory()}
+            event.update(fields)
+            self._callback(event)
+
+    def percentiles(self, name, q=(50, 90, 99)):
+        # Over the last `window` spans of that name.
+        with self._lock:
+            durations = list(self._durations.get(name, ()))
+        if not durations:
+            return {}
+        return dict(zip(q, np.percentile(durations, q).tolist()))
+
+
+class NullTracer(Tracer):
+
+    _SPAN = NullSpan()
+
+    @property
+    def enabled(self):
+        return False
+
+    def span(self, name, **fields):
+        return self._SPAN
+
+    def emit(self, name, duration, **fields):
+        pass
+
+
+class JsonLinesSink:
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1)
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+
+def onnx_available():
+    return importlib.util.find_spec("onnxruntime") is not None
+
+
+class OnnxModel:
+
+    def __init__(self, path, threads=None):
+        import onnxruntime
+        import torch
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = \
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        # Same thread budget as torch, see RuntimeConfig.apply.
+        options.intra_op_num_threads = threads if threads is not None \
+            else torch.get_num_threads()
+        options.inter_op_num_threads = 1
+        # Input lengths change from call to call, a memory pattern planned
+        # for one shape is never reused.
+        options.enable_mem_pattern = False
+        self._session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"])
+        self._input = self._session.get_inputs()[0].name
+
+    def run(self, audio):
+        import torch
+        outputs = self._session.run(None, {self._input: np.ascontiguousarray(
+            audio.detach().cpu().numpy(), dtype=np.float32)})
+        return [torch.from_numpy(i) for i in outputs]
+
+    def __call__(self, audio):
+        return self.run(audio)[0]
+
+    def extract_features(self, waveforms, num_layers=None):
+        return self.run(waveforms)[:num_layers], None
+
+
+class RuntimeConfig:
+
+    def __init__(self, threads=None, interop_threads=None, quantize=False,
+                 inference_mode=True, backend="torch"):
+        self._threads = threads
+        self._interop_threads = interop_threads
+        self._quantize = quantize
+        self._inference_mode = inference_mode
+        self._backend = backend
+
+    @property
+    def threads(self):
+        return self._threads
+
+    @property
+    def interop_threads(self):
+        return self._interop_threads
+
+    @property
+    def quantize(self):
+        return self._quantize
+
+    @property
+    def backend(self):
+        # ONNX Runtime is optional, without it every model runs on torch.
+        if self._backend == "onnx" and onnx_available():
+            return "onnx"
+        return "torch"
+
+    def apply(self):
+        # Called by every constructor, torch is only imported when there is
+        # something to set.
+        if self._threads is None and self._interop_threads is None:
+            return
+        import torch
+        if self._threads is not None:
+            torch.set_num_threads(self._threads)
+        if self._interop_threads is not None and \
+                torch.get_num_interop_threads() != self._interop_threads:
+            try:
+                torch.set_num_interop_threads(self._interop_threads)
+            except RuntimeError:
+                # Only possible before the first inter-op parallel work.
+                pass
+
+    def context(self):
+        import torch
+        if self._inference_mode:
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def options(self, name):
+        options = {} if self.backend == "torch" else {"backend": self.backend}
+        if not self._quantize:
+            return options
+        # The quantized silero STT is TorchScript that does not export, ONNX
+        # runs the full model. silero VAD has no quantized variant.
+        if name == "silero_stt" and self.backend == "torch":
+            options["jit_model"] = "jit_q"
+        elif name.startswith("wav2vec2"):
+            options["quantize"] = True
+        return options
+
+    def _timed(self, function, repeat):
+        with self.context():
+            result = function()
+            start = time.perf_counter()
+            for _ in range(repeat):
+                function()
+        return result, (time.perf_counter() - start) / repeat
+
+    def report(self, audio, models=None, layer=4, repeat=3):
+        models = models if models is not None else registry
+        report = {}
+
+        vad = SpeechChunker(models=models, runtime=self)
+        _, latency = self._timed(lambda: vad.speech_probs(audio), repeat)
+        report["silero_vad"] = {"latency": latency, "quantized": None,
+                                "agreement": None}
+
+        stt = ShadowFormatter(vad, store=SubtitleStore(":memory:"),
+                              models=models, runtime=self)
+        quantized = ShadowFormatter(
+            vad, store=SubtitleStore(":memory:"), models=models,
+            runtime=RuntimeConfig(self._threads, self._interop_threads, True,
+                                  self._inference_mode))
+        text, latency = self._timed(lambda: stt.subtitle(audio), repeat)
+        quantized_text, quantized_latency = self._timed(
+            lambda: quantized.subtitle(audio), repeat)
+        report["silero_stt"] = {
+            "latency": latency, "quantized": quantized_latency,
+            "agreement": difflib.SequenceMatcher(
+                None, text, quantized_text).ratio()}
+
+        for name in ("wav2vec2_large", "wav2vec2_base"):
+            comparator = SpeechComparator(
+                models=models, model=name, layer=layer, runtime=self)
+            quantized = SpeechComparator(
+                models=models, model=name, layer=layer,
+                runtime=RuntimeConfig(self._threads, self._interop_threads,
+                                      True, self._inference_mode))
+            features, latency = self._timed(
+                lambda: comparator.extract_features(audio), repeat)
+            quantized_features, quantized_latency = self._timed(
+                lambda: quantized.extract_features(audio), repeat)
+            report[name] = {
+                "latency": latency, "quantized": quantized_latency,
+                "agreement": float((features * quantized_features).sum() / (
+                    features.norm() * quantized_features.norm() + 1e-8))}
+        return report
+
+    def backends(self, audio, models=None, layer=4, repeat=3):
+        import torch
+        models = models if models is not None else registry
+        report = {}
+        outputs = {}
+        for backend in ("torch", "onnx"):
+            config = RuntimeConfig(self._threads, self._interop_threads,
+                                   self._quantize, self._inference_mode,
+                                   backend)
+            if config.backend != backend:
+                continue
+            chunker = SpeechChunker(models=models, runtime=config)
+            formatter = ShadowFormatter(
+                chunker, store=SubtitleStore(":memory:"), models=models,
+                runtime=config)
+            comparator = SpeechComparator(
+                models=models, model="wav2vec2_large", layer=layer,
+                runtime=config)
+            for name, function in (
+                    ("silero_vad", lambda: torch.from_numpy(
+                        chunker.speech_probs(audio))),
+                    ("silero_stt", lambda: formatter.subtitle(audio)),
+                    ("wav2vec2_large",
+                     lambda: comparator.extract_features(audio))):
+                outputs[name, backend], latency = config._timed(
+                    function, repeat)
+                report.setdefault(name, {"torch": None, "onnx": None,
+                                         "agreement": None})[backend] = latency
+        for name in report:
+            if (name, "onnx") not in outputs:
+                continue
+            reference, output = outputs[name, "torch"], outputs[name, "onnx"]
+            if name == "silero_stt":
+                agreement = difflib.SequenceMatcher(
+                    None, reference, output).ratio()
+            else:
+                agreement = float((reference * output).sum() / (
+                    reference.norm() * output.norm() + 1e-8))
+            report[name]["agreement"] = agreement
+        return report
+
+
+class ModelRegistry:
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get("ECHOMASTER_MODELS")
+        self._directory = directory
+        self._models = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+        self._locks = collections.defaultdict(threading.Lock)
+        self._loaders = {
+            "silero_vad": self._silero_vad,
+            "silero_stt": self._silero_stt,
+            "wav2vec2_large": functools.partial(
+                self._wav2vec2, "wav2vec2_large"),
+            "wav2vec2_base": functools.partial(
+                self._wav2vec2, "wav2vec2_base"),
+        }
+
+    @property
+    def directory(self):
+        return self._directory
+
+    @directory.setter
+    def directory(self, directory):
+        self._directory = directory
+
+    @property
+    def timings(self):
+        return dict(self._timings)
+
+    def loaded(self, name, **options):
+        return (name, tuple(sorted(options.items()))) in self._models
+
+    def get(self, name, **options):
+        key = (name, tuple(sorted(options.items())))
+        model = self._models.get(key)
+        if model is not None:
+            return model
+        with self._lock:
+            lock = self._locks[key]
+        with lock:
+            if key not in self._models:
+                start = time.perf_counter()
+                self._models[key] = self._loaders[name](**options)
+                self._timings[key] = time.perf_counter() - start
+            return self._models[key]
+
+    def preload(self, *names):
+        for name in names or self._loaders:
+            self.get(name)
+
+    def _hub(self, repo, **kwargs):
+        import torch
+        # A local checkout (with its weights) is used as is and never
+        # touches the network.
+        if self._directory is not None:
+            return torch.hub.load(
+                os.path.join(self._directory, repo.split("/")[-1]),
+                source="local", **kwargs)
+        return torch.hub.load(repo, **kwargs)
+
+    def _onnx(self, model, name=None, quantize=False):
+        import torch
+        # Exports are cached under name, models without a stable name (no
+        # weights file) are exported on every load. Returns None when the
+        # model cannot be exported so that it runs on torch.
+        directory = os.path.join(cache_directory(), "onnx")
+        path = None if name is None else os.path.join(
+            directory, name + ("-int8" if quantize else "") + ".onnx")
+        if path is not None and os.path.isfile(path):
+            return OnnxModel(path)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                exported = os.path.join(tmp, "model.onnx")
+                with torch.no_grad():
+                    torch.onnx.export(
+                        model, (torch.randn(1, 16000),), exported,
+                        input_names=["audio"],
+                        dynamic_axes={"audio": {0: "batch", 1: "samples"}},
+                        opset_version=17, dynamo=False)
+                if quantize:
+                    from onnxruntime.quantization import (QuantType,
+                                                          quantize_dynamic)
+                    quantize_dynamic(exported, os.path.join(tmp, "int8.onnx"),
+                                     weight_type=QuantType.QInt8)
+                    exported = os.path.join(tmp, "int8.onnx")
+                if path is None:
+                    return OnnxModel(exported)
+                os.makedirs(directory, exist_ok=True)
+                shutil.copyfile(exported, path + ".{}.tmp".format(os.getpid()))
+                os.replace(path + ".{}.tmp".format(os.getpid()), path)
+        except Exception as e:
+            warnings.warn("Running {} on torch, ONNX export failed: {}".format(
+                name or type(model).__name__, e))
+            return None
+        return OnnxModel(path)
+
+    def _silero_vad(self, backend="torch"):
+        # silero publishes the VAD as ONNX, with the same interface.
+        return self._hub('snakers4/silero-vad', model='silero_vad',
+                         onnx=backend == "onnx")
+
+    def _silero_stt(self, jit_model='jit_xlarge', language='en',
+                    backend="torch"):
+        model, decoder, utils = self._hub(
+            'snakers4/silero-models', model='silero_stt', jit_model=jit_model,
+            language=language)
+        if backend == "onnx":
+            model = self._onnx(
+                model, "silero_stt-{}-{}".format(language, jit_model)) or model
+        return model, decoder, utils
+
+    def _wav2vec2(self, name, num_layers=None, quantize=False,
+                  backend="torch"):
+        import torch
+        import torchaudio
+        model = getattr(torchaudio.models, name)()
+        key = None
+        if self._directory is not None:
+            weights = os.path.join(self._directory, name + ".pt")
+            if os.path.isfile(weights):
+                model.load_state_dict(torch.load(weights, map_location="cpu"))
+                stat = os.stat(weights)
+                key = "{}-{}-{}-{}".format(
+                    name, num_layers, stat.st_size, stat.st_mtime_ns)
+        if num_layers is not None:
+            # Layers past the one that is used are never run, drop them.
+            del model.encoder.transformer.layers[num_layers:]
+        model.eval()
+        if backend == "onnx":
+            onnx = self._onnx(feature_layers(model), key, quantize)
+            if onnx is not None:
+                return onnx
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+
+def feature_layers(model):
+    import torch
+
+    # Exports the output of every layer, as extract_features returns them.
+    class FeatureLayers(torch.nn.Module):
+
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, waveforms):
+            features, _ = self.model.extract_features(waveforms)
+            return tuple(features)
+
+    return FeatureLayers(model)
+
+
+registry = ModelRegistry()
+
+
+class SubtitleStore:
+
+    def __init__(self, path=None, max_entries=200000):
+        if path is None:
+            os.makedirs(cache_directory(), exist_ok=True)
+            path = os.path.join(cache_directory(), "subtitles.sqlite")
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        # Batch workers share the store from several processes.
+        self._connection = sqlite3.connect(
+            path, timeout=30, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS subtitles ("
+                "digest TEXT, start_ms REAL, end_ms REAL, model TEXT, "
+                "text TEXT, used REAL, "
+                "PRIMARY KEY (digest, start_ms, end_ms, model))")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS subtitles_used ON subtitles (used)")
+
+    @property
+    def max_entries(self):
+        return self._max_entries
+
+    @max_entries.setter
+    def max_entries(self, max_entries):
+        self._max_entries = max_entries
+        self.evict()
+
+    def get(self, digest, start, end, model):
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT text FROM subtitles WHERE digest = ? AND start_ms = ? "
+                "AND end_ms = ? AND model = ?",
+                (digest, start, end, model)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE subtitles SET used = ? WHERE digest = ? AND "
+                "start_ms = ? AND end_ms = ? AND model = ?",
+                (time.time(), digest, start, end, model))
+        return row[0]
+
+    def lookup(self, digest, model):
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                "SELECT start_ms, end_ms, text FROM subtitles "
+                "WHERE digest = ? AND model = ?", (digest, model)).fetchall()
+            self._connection.execute(
+                "UPDATE subtitles SET used = ? WHERE digest = ? AND model = ?",
+                (time.time(), digest, model))
+        return {(start, end): text for start, end, text in rows}
+
+    def put(self, digest, start, end, model, text):
+        self.update(digest, model, {(start, end): text})
+
+    def update(self, digest, model, subtitles):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO subtitles VALUES (?, ?, ?, ?, ?, ?)",
+                [(digest, start, end, model, text, now)
+                 for (start, end), text in subtitles.items()])
+        self.evict()
+
+    def evict(self):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM subtitles WHERE rowid IN (SELECT rowid FROM "
+                "subtitles ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self._max_entries,))
+
+    def close(self):
+        self._connection.close()
+
+
+class PhraseIndex:
+
+    def __init__(self, bounds=()):
+        bounds = np.asarray(bounds, np.float64).reshape(-1, 2)
+        self._bounds = np.empty((max(len(bounds), 16), 2))
+        self._bounds[:len(bounds)] = bounds
+        self._length = len(bounds)
+        self._start = 0
+        self._stop = None
+        self._order = None
+        self._position = -1
+        self._moved = True
+        self._loop = False
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [tuple(i) for i in self.array[index].tolist()]
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("phrase index out of range")
+        return tuple(self._bounds[index].tolist())
+
+    def __iter__(self):
+        return (tuple(i) for i in self.array.tolist())
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(
+                tuple(a) == tuple(b) for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return "PhraseIndex({!r})".format(self[:])
+
+    @property
+    def array(self):
+        return self._bounds[:self._length]
+
+    def append(self, start, end):
+        # Filled in place while streaming, growing geometrically.
+        if self._length == len(self._bounds):
+            bounds = np.empty((2 * len(self._bounds), 2))
+            bounds[:self._length] = self._bounds[:self._length]
+            self._bounds = bounds
+        self._bounds[self._length] = (start, end)
+        self._length += 1
+
+    def at(self, ms):
+        # Phrase playing at `ms`, or the last one before it in a pause.
+        index = int(np.searchsorted(
+            self._bounds[:self._length, 0], ms, side="right")) - 1
+        return max(index, 0) if self._length else None
+
+    @property
+    def loop(self):
+        return self._loop
+
+    @loop.setter
+    def loop(self, loop):
+        self._loop = loop
+
+    @property
+    def range(self):
+        return (self._start, self._length if self._stop is None
+                else self._stop)
+
+    def _count(self):
+        stop = self._length if self._stop is None else min(
+            self._stop, self._length)
+        return max(stop - self._start, 0)
+
+    def _phrase(self, position):
+        if self._order is not None:
+            return int(self._order[position])
+        return self._start + position
+
+    @property
+    def index(self):
+        if self._position < 0:
+            return -1
+        return self._phrase(self._position)
+
+    @property
+    def bounds(self):
+        if self._position < 0:
+            return None
+        return self[self.index]
+
+    def select(self, start=0, stop=None, shuffle=False, seed=None):
+        # Plays phrases [start, stop), in order or shuffled; stop=None
+        # follows phrases appended while streaming.
+        self._start = start
+        self._stop = stop
+        self._order = None
+        if shuffle:
+            self._order = self._start + np.random.default_rng(
+                seed).permutation(self._count())
+        self.rewind()
+
+    def rewind(self):
+        self._position = -1
+        self._moved = True
+
+    def seek(self, index):
+        # The next phrase returned is `index`.
+        if self._order is not None:
+            position = np.flatnonzero(self._order == index)
+            if not len(position):
+                raise IndexError("phrase {} is not selected".format(index))
+            self._position = int(position[0]) - 1
+        else:
+            if not self._start <= index < self._start + self._count():
+                raise IndexError("phrase {} is not selected".format(index))
+            self._position = index - self._start - 1
+        self._moved = True
+
+    def _repeating(self):
+        return self._loop and not self._moved
+
+    def pending(self):
+        if self._repeating():
+            return True
+        count = len(self._order) if self._order is not None \
+            else self._count()
+        return self._position + 1 < count
+
+    def __next__(self):
+        if not self._repeating():
+            if not self.pending():
+                raise StopIteration
+            self._position += 1
+            self._moved = False
+        return self.bounds
 
 
 class SpeechChunker:
 
-    def __init__(self, chunk_duration=10):
+    def __init__(self, chunk_duration=10, cache=None, models=None,
+                 runtime=None, tracer=None):
+        self._models = models if models is not None else registry
+        self._runtime = runtime if runtime is not None else RuntimeConfig()
+        self._runtime.apply()
+        self._tracer = tracer if tracer is not None else NullTracer()
         self._data = None
         self._chunk_duration = chunk_duration
         self._url = None
-        self._phrases = None
-        self.model, self.utils = torch.hub.load(
-            'snakers4/silero-vad', model='silero_vad')
+        self._cache = cache if cache is not None else AudioCache()
+        self._entry = None
+        self._lease = None
+        self._digest = None
+        self._waveform = None
+        self._chunks = PhraseIndex()
+        self._partial = None
+        self._streamer = None
+        self._streaming = False
+        self._stream_error = None
+        self._resegment = False
+        self._arrived = threading.Condition()
+        self._stream_cancel = threading.Event()
+        self._probs = None
+        self._length = 0
+        self._threshold = 0.2
+        self._speech_pad_ms = 80
+        self._min_speech_duration_ms = 1000
+        self._min_silence_duration_ms = 50
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        start, end = next(self._phrases)
-        return self._data[start:end]
+        with self._arrived:
+            # While streaming, wait for the next phrase to be cut.
+            while self._streaming and not self._chunks.pending():
+                self._arrived.wait()
+            if self._stream_error is not None and \
+                    not self._chunks.pending():
+                raise self._stream_error
+        start, end = next(self._chunks)
+        return self._audio(start, end)
+
+    def phrase(self, index):
+        return self._audio(*self._chunks[index])
+
+    def frames(self, index):
+        # Frame rate and frame count of phrase(index), without decoding it.
+        start, end = self._chunks[index]
+        with self._arrived:
+            data = self._data
+        if data is None:
+            return 16000, max(int(end * 16) - int(start * 16), 0)
+        if isinstance(data, AudioSegment):
+            return data.frame_rate, int(data[start:end].frame_count())
+        return data.frame_rate, data.frames(start, end)
+
+    @property
+    def data(self):
+        return self._data
+
+    def _audio(self, start, end):
+        with self._arrived:
+            data = self._data
+            if data is None:
+                samples = self._streamed(start, end)
+        if data is not None:
+            return data[start:end]
+        samples = np.clip(samples * 32768, -32768, 32767).astype(np.int16)
+        return AudioSegment(data=samples.tobytes(), sample_width=2,
+                            frame_rate=16000, channels=1)
+
+    def _streamed(self, start, end):
+        # Still streaming: phrases are cut from the 16 kHz audio written to
+        # the private cache directory so far.
+        start = int(start * 16)
+        return np.fromfile(self._partial, np.float32,
+                           count=max(int(end * 16) - start, 0),
+                           offset=start * 4)
+
+    @property
+    def model(self):
+        return self._models.get(
+            "silero_vad", **self._runtime.options("silero_vad"))[0]
+
+    @property
+    def utils(self):
+        return self._models.get(
+            "silero_vad", **self._runtime.options("silero_vad"))[1]
+
+    @property
+    def phrases(self):
+        return self._chunks
+
+    @property
+    def index(self):
+        return self._chunks.index
+
+    @property
+    def bounds(self):
+        return self._chunks.bounds
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self._tracer = tracer if tracer is not None else NullTracer()
+
+    @property
+    def waveform(self):
+        if self._waveform is None and self._data is not None:
+            with self._tracer.span("resample") as span:
+                if isinstance(self._data, MappedAudio):
+                    self._waveform = self._data.resample(
+                        os.path.join(self._entry, "audio16k.f32"))
+                elif isinstance(self._data, SourceAudio):
+                    # Decoded at 16 kHz when the source was ingested.
+                    self._waveform = mapped(
+                        os.path.join(self._entry, "audio16k.f32"))
+                else:
+                    self._waveform = waveform(self._data)
+                span["bytes"] = self._waveform.numel() * 4
+        return self._waveform
+
+    def slice(self, start, end):
+        import torch
+        with self._arrived:
+            if self._data is None and self._partial is not None:
+                return torch.from_numpy(self._streamed(start, end))
+        return self.waveform[int(start * 16):int(end * 16)]
 
     def reset(self):
-        self.process()
+        self._chunks.rewind()
 
     @property
     def url(self):
@@ -43,6 +1248,27 @@ class SpeechChunker:
     def url(self, url):
         self._url = url
 
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def digest(self):
+        if self._digest is None and self._entry is not None:
+            self._digest = self._cache.digest(self._entry)
+        return self._digest
+
+    @property
+    def source(self):
+        if self._url is not None and os.path.isfile(self._url):
+            return os.path.abspath(self._url)
+        if self._entry is None:
+            return None
+        for name in ("source.m4a", "source"):
+            if os.path.isfile(os.path.join(self._entry, name)):
+                return os.path.join(self._entry, name)
+        return None
+
     @property
     def chunk_duration(self):
         return self._chunk_duration
@@ -50,199 +1276,1173 @@ class SpeechChunker:
     @chunk_duration.setter
     def chunk_duration(self, chunk_duration):
         self._chunk_duration = chunk_duration
-        self.process()
+        self.segment()
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    @threshold.setter
+    def threshold(self, threshold):
+        self._threshold = threshold
+        self.segment()
+
+    @property
+    def speech_pad_ms(self):
+        return self._speech_pad_ms
+
+    @speech_pad_ms.setter
+    def speech_pad_ms(self, speech_pad_ms):
+        self._speech_pad_ms = speech_pad_ms
+        self.segment()
+
+    @property
+    def min_speech_duration_ms(self):
+        return self._min_speech_duration_ms
+
+    @min_speech_duration_ms.setter
+    def min_speech_duration_ms(self, min_speech_duration_ms):
+        self._min_speech_duration_ms = min_speech_duration_ms
+        self.segment()
+
+    @property
+    def min_silence_duration_ms(self):
+        return self._min_silence_duration_ms
+
+    @min_silence_duration_ms.setter
+    def min_silence_duration_ms(self, min_silence_duration_ms):
+        self._min_silence_duration_ms = min_silence_duration_ms
+        self.segment()
 
-    def load(self):
+    def load(self, stream=False):
+        if stream:
+            self.stream()
+            return
         self.download()
         self.process()
 
+    def ingest(self, source):
+        if not hasattr(source, "read"):
+            self.url = os.fspath(source)
+            self.load()
+            return
+        self.cancel()
+        self._url = None
+        self._open(self._spool(source))
+        self.process()
+
+    def _spool(self, source):
+        # ffmpeg needs a seekable input for some containers (e.g. mp4 with
+        # its index at the end), so file objects and pipes are copied into
+        # the cache first and keyed by their content.
+        digest = hashlib.sha1()
+        fd, spool = tempfile.mkstemp(
+            prefix=".spool-", dir=self._cache.directory)
+        try:
+            with self._tracer.span("spool") as span, os.fdopen(fd, "wb") as f:
+                for block in iter(functools.partial(source.read, 1 << 20),
+                                  b""):
+                    digest.update(block)
+                    f.write(block)
+                span["bytes"] = f.tell()
+            key = digest.hexdigest()
+            entry = self._cache.get(key)
+            if entry is None:
+                def build(directory):
+                    os.replace(spool, os.path.join(directory, "source"))
+                    self._decode(os.path.join(directory, "source"), directory)
+                entry = self._cache.put(key, build)
+        finally:
+            if os.path.exists(spool):
+                os.remove(spool)
+        return entry
+
+    def _key(self):
+        if os.path.isfile(self._url):
+            # Local files are not copied: the entry only holds the analysis
+            # audio and is invalidated when the file changes.
+            stat = os.stat(self._url)
+            return self._cache.key("{}:{}:{}".format(
+                os.path.abspath(self._url), stat.st_size, stat.st_mtime_ns))
+        return self._cache.key(self._url)
+
     def download(self):
         if self._url is None:
             return None
 
+        self.cancel()
+
+        key = self._key()
+        with self._tracer.span("download", cached=True) as span:
+            entry = self._cache.get(key)
+            lease = None if entry is None else self._cache.lease(entry)
+            if lease is None:
+                span["cached"] = False
+                entry = self._cache.put(key, self._fetch)
+        self._open(entry, lease)
+
+    def _release(self):
+        if self._lease is not None:
+            self._lease.close()
+            self._lease = None
+
+    def _open(self, entry, lease=None):
+        # The entry is kept out of eviction while it is open.
+        if lease is None:
+            lease = self._cache.lease(entry)
+        if lease is None:
+            raise FileNotFoundError("Cache entry {} was evicted".format(entry))
+        self._release()
+        self._lease = lease
+        self._entry = entry
+        self._digest = None
+        self._waveform = None
+        wav = os.path.join(entry, "audio.wav")
+        if os.path.isfile(wav):
+            # Entries decoded at full rate by earlier versions.
+            self._data = MappedAudio(wav)
+        else:
+            self._data = SourceAudio(self.source)
+
+    def stream(self):
+        if self._url is None:
+            return None
+
+        self.cancel()
+        if os.path.isfile(self._url) or \
+                self._cache.get(self._key()) is not None:
+            self.load()
+            return
+
+        self._release()
+        self._entry = None
+        self._digest = None
+        self._data = None
+        self._waveform = None
+        self._probs = None
+        self._chunks = PhraseIndex()
+        self._streaming = True
+        self._stream_error = None
+        self._resegment = False
+        self._stream_cancel = threading.Event()
+        self._streamer = threading.Thread(
+            target=self._stream, args=(
+                self._url, self._key(), self._chunks, self._stream_cancel),
+            daemon=True)
+        self._streamer.start()
+
+    def cancel(self):
+        self._stream_error = None
+        if self._streamer is not None:
+            self._stream_cancel.set()
+            self._streamer.join()
+            self._streamer = None
+        self._discard()
+
+    def _discard(self):
+        with self._arrived:
+            partial, self._partial = self._partial, None
+        if partial is not None:
+            shutil.rmtree(os.path.dirname(partial), ignore_errors=True)
+
+    def _stream(self, url, key, phrases, cancel, window_size_samples=512):
+        import torch
+        started = time.perf_counter()
+        position = 0
+        processes = []
+        tee = None
+        # The download is kept next to the 16 kHz analysis audio and both are
+        # published to the cache once the stream is complete.
+        directory = tempfile.mkdtemp(prefix=".stream-",
+                                     dir=self._cache.directory)
+        partial = os.path.join(directory, "audio16k.f32")
+        open(partial, "wb").close()
+        with self._arrived:
+            self._partial = partial
+        try:
+            download = subprocess.Popen(
+                [sys.executable, "-m", "yt_dlp", "--quiet", "--no-warnings",
+                 "-f", "m4a/bestaudio/best", "-o", "-", url],
+                stdout=subprocess.PIPE)
+            processes.append(download)
+            decode = subprocess.Popen(
+                ["ffmpeg", "-loglevel", "error", "-i", "pipe:0",
+                 "-f", "f32le", "-ac", "1", "-ar", "16000", "pipe:1"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            processes.append(decode)
+            tee = threading.Thread(target=self._tee, args=(
+                download.stdout, os.path.join(directory, "source"),
+                decode.stdin), daemon=True)
+            tee.start()
+
+            vad = self.utils[3](
+                self.model,
+                threshold=self._threshold,
+                sampling_rate=16000,
+                min_silence_duration_ms=self._min_silence_duration_ms,
+                speech_pad_ms=self._speech_pad_ms)
+            max_speech_samples = self._chunk_duration * 16000
+            min_speech_samples = self._min_speech_duration_ms * 16
+            start = None
+
+            def close(end):
+                if end - start > min_speech_samples:
+                    with self._arrived:
+                        phrases.append(start / 16, end / 16)
+                        self._arrived.notify_all()
+
+            with self._runtime.context(), open(partial, "ab", 0) as f:
+                while not cancel.is_set():
+                    block = decode.stdout.read(window_size_samples * 4)
+                    if not block:
+                        break
+                    f.write(block)
+                    position += len(block) // 4
+                    chunk = torch.from_numpy(np.frombuffer(
+                        block, np.float32).copy())
+                    if len(chunk) < window_size_samples:
+                        chunk = torch.nn.functional.pad(
+                            chunk, (0, window_size_samples - len(chunk)))
+                    event = vad(chunk)
+                    if event and "start" in event:
+                        start = event["start"]
+                    elif event and "end" in event and start is not None:
+                        close(event["end"])
+                        start = None
+                    elif start is not None and \
+                            position - start >= max_speech_samples:
+                        close(position)
+                        start = position
+            if not cancel.is_set():
+                tee.join()
+                for name, process in (("yt_dlp", download),
+                                      ("ffmpeg", decode)):
+                    if process.wait() != 0:
+                        raise RuntimeError("{} exited with status {}".format(
+                            name, process.returncode))
+                if start is not None:
+                    close(position)
+                # Probed before anything moves, so that phrases can still be
+                # read from the streamed audio if the source cannot be opened.
+                SourceAudio(os.path.join(directory, "source"))
+
+                def build(entry):
+                    for name in ("source", "audio16k.f32"):
+                        os.replace(os.path.join(directory, name),
+                                   os.path.join(entry, name))
+                # Phrases are decoded from the source from now on.
+                with self._arrived:
+                    self._open(self._cache.put(key, build))
+                    resegment, self._resegment = self._resegment, False
+                # Settings changed while streaming.
+                if resegment:
+                    self.process()
+        except Exception as e:
+            self._stream_error = e
+        finally:
+            for process in processes:
+                if process.poll() is None:
+                    process.kill()
+                process.wait()
+            if tee is not None:
+                tee.join()
+            # After a failure, the phrases already cut are read from the
+            # streamed audio until the next load.
+            if self._stream_error is None:
+                self._discard()
+            with self._arrived:
+                self._streaming = False
+                self._arrived.notify_all()
+            self._tracer.emit("stream", time.perf_counter() - started,
+                              bytes=position * 4, phrases=len(phrases),
+                              cancelled=cancel.is_set(),
+                              error=type(self._stream_error).__name__
+                              if self._stream_error is not None else None)
+
+    def _tee(self, download, path, decode):
+        try:
+            with open(path, "wb") as f:
+                for block in iter(functools.partial(download.read, 1 << 16),
+                                  b""):
+                    f.write(block)
+                    decode.write(block)
+        except OSError:
+            # ffmpeg exited, its status is checked by the stream.
+            pass
+        finally:
+            download.close()
+            try:
+                decode.close()
+            except OSError:
+                pass
+
+    def _fetch(self, directory):
+        if os.path.isfile(self._url):
+            self._decode(self._url, directory)
+            return
+
+        import yt_dlp
         ydl_opts = {
             'format': 'm4a/bestaudio/best',
-            'outtmpl': 'data.m4a',
+            'outtmpl': os.path.join(directory, 'source.%(ext)s'),
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': 'm4a',
             }]
         }
 
-        # TODO: direct access
-        try:
-            os.remove("data.m4a")
-        except BaseException:
-            pass
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download(self._url)
+        with self._tracer.span("fetch") as span:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.download([self._url])
+            span["bytes"] = os.path.getsize(
+                os.path.join(directory, "source.m4a"))
+
+        self._decode(os.path.join(directory, "source.m4a"), directory)
 
-        self._data = AudioSegment.from_file(
-            "data.m4a", "m4a")
+    def _decode(self, source, directory):
+        # Only the 16 kHz analysis audio is kept, phrases are decoded from
+        # the source when they are played.
+        with self._tracer.span("decode") as span:
+            path = decode(source, os.path.join(directory, "audio16k.f32"),
+                          SourceAudio(source).channels)
+            span["bytes"] = os.path.getsize(path)
 
     def process(self):
-        audio = np.frombuffer(self._data.raw_data, np.int16).copy()
-        audio = audio.reshape(
-            len(audio) //
-            self._data.channels,
-            self._data.channels).mean(
-            axis=1)
-        audio = audio.astype(np.float32) / 32767.5
-        resampler = torchaudio.transforms.Resample(
-            orig_freq=self._data.frame_rate, new_freq=16000)
-        audio = torch.tensor(audio).unsqueeze(0)
-        audio = resampler(audio)
-        nonsilent_chunks = [
-            (i["start"] *
-             1000,
-             i["end"] *
-                1000) for i in self.utils[0](
-                audio,
-                self.model,
-                sampling_rate=16000,
-                threshold=0.2,
-                return_seconds=True,
-                speech_pad_ms=80,
-                min_speech_duration_ms=1000,
+        vad = None if self._entry is None else os.path.join(
+            self._entry, "vad.npz")
+        if vad is not None and os.path.isfile(vad):
+            with np.load(vad) as cached:
+                self._probs = cached["probs"]
+                self._length = int(cached["length"])
+        else:
+            audio = self.waveform
+            with self._tracer.span("vad", samples=audio.shape[-1]):
+                self._probs = self.speech_probs(audio)
+            self._length = audio.shape[-1]
+            if vad is not None:
+                tmp = vad + ".{}.tmp".format(os.getpid())
+                with open(tmp, "wb") as f:
+                    np.savez(f, probs=self._probs, length=self._length)
+                os.replace(tmp, vad)
+        self.segment()
+
+    def speech_probs(self, audio, window_size_samples=512):
+        import torch
+        audio = audio.reshape(-1)
+        model = self.model
+        model.reset_states()
+        probs = np.empty(
+            (len(audio) + window_size_samples - 1) // window_size_samples,
+            np.float32)
+        with self._runtime.context():
+            for i, start in enumerate(
+                    range(0, len(audio), window_size_samples)):
+                chunk = audio[start:start + window_size_samples]
+                if len(chunk) < window_size_samples:
+                    chunk = torch.nn.functional.pad(
+                        chunk, (0, window_size_samples - len(chunk)))
+                probs[i] = model(chunk, 16000).item()
+        return probs
+
+    def segment(self, sampling_rate=16000):
+        if self._probs is None:
+            # Streamed tracks only get their probabilities once re-segmented,
+            # after the stream is published.
+            with self._arrived:
+                streaming = self._data is None and self._streaming
+                if streaming:
+                    self._resegment = True
+            if not streaming and self._data is not None:
+                self.process()
+            return
+        # Recent silero versions expose the segmentation step on its own.
+        from_probs = getattr(sys.modules.get(self.utils[0].__module__),
+                             "get_speech_timestamps_from_probs", None)
+        if from_probs is not None:
+            speeches = from_probs(
+                self._probs.tolist(),
+                sampling_rate=sampling_rate,
+                threshold=self._threshold,
+                min_speech_duration_ms=self._min_speech_duration_ms,
                 max_speech_duration_s=self._chunk_duration,
-                min_silence_duration_ms=50)]
-        self._phrases = iter(nonsilent_chunks)
+                min_silence_duration_ms=self._min_silence_duration_ms,
+                speech_pad_ms=self._speech_pad_ms,
+                audio_length_samples=self._length)
+        else:
+            speeches = self._timestamps(sampling_rate=sampling_rate)
+
+        length_seconds = self._length / sampling_rate
+        nonsilent_chunks = [
+            (max(round(i['start'] / sampling_rate, 1), 0) * 1000,
+             min(round(i['end'] / sampling_rate, 1), length_seconds) * 1000)
+            for i in speeches]
+        self._chunks = PhraseIndex(nonsilent_chunks)
+
+    def _timestamps(self, window_size_samples=512, sampling_rate=16000):
+        # Same state machine as get_speech_timestamps in older silero
+        # versions, replayed over the cached frame probabilities.
+        min_speech_samples = sampling_rate * self._min_speech_duration_ms / 1000
+        speech_pad_samples = sampling_rate * self._speech_pad_ms / 1000
+        max_speech_samples = sampling_rate * self._chunk_duration - \
+            window_size_samples - 2 * speech_pad_samples
+        min_silence_samples = sampling_rate * self._min_silence_duration_ms / 1000
+        min_silence_samples_at_max_speech = sampling_rate * 98 / 1000
+        neg_threshold = max(self._threshold - 0.15, 0.01)
+
+        triggered = False
+        speeches = []
+        current_speech = {}
+        temp_end = 0
+        prev_end = next_start = 0
+        for i, speech_prob in enumerate(self._probs.tolist()):
+            position = window_size_samples * i
+            if (speech_prob >= self._threshold) and temp_end:
+                temp_end = 0
+                if next_start < prev_end:
+                    next_start = position
+
+            if (speech_prob >= self._threshold) and not triggered:
+                triggered = True
+                current_speech['start'] = position
+                continue
+
+            if triggered and position - \
+                    current_speech['start'] > max_speech_samples:
+                if prev_end:
+                    current_speech['end'] = prev_end
+                    speeches.append(current_speech)
+                    current_speech = {}
+                    if next_start < prev_end:
+                        triggered = False
+                    else:
+                        current_speech['start'] = next_start
+                    prev_end = next_start = temp_end = 0
+                else:
+                    current_speech['end'] = position
+                    speeches.append(current_speech)
+                    current_speech = {}
+                    prev_end = next_start = temp_end = 0
+                    triggered = False
+                    continue
+
+            if (speech_prob < neg_threshold) and triggered:
+                if not temp_end:
+                    temp_end = position
+                if position - temp_end > min_silence_samples_at_max_speech:
+                    prev_end = temp_end
+                if position - temp_end < min_silence_samples:
+                    continue
+                current_speech['end'] = temp_end
+                if (current_speech['end'] -
+                        current_speech['start']) > min_speech_samples:
+                    speeches.append(current_speech)
+                current_speech = {}
+                prev_end = next_start = temp_end = 0
+                triggered = False
+
+        if current_speech and (
+                self._length - current_speech['start']) > min_speech_samples:
+            current_speech['end'] = self._length
+            speeches.append(current_speech)
+
+        for i, speech in enumerate(speeches):
+            if i == 0:
+                speech['start'] = int(
+                    max(0, speech['start'] - speech_pad_samples))
+            if i != len(speeches) - 1:
+                silence_duration = speeches[i + 1]['start'] - speech['end']
+                if silence_duration < 2 * speech_pad_samples:
+                    speech['end'] += int(silence_duration // 2)
+                    speeches[i + 1]['start'] = int(
+                        max(0, speeches[i + 1]['start'] - silence_duration // 2))
+                else:
+                    speech['end'] = int(
+                        min(self._length, speech['end'] + speech_pad_samples))
+                    speeches[i + 1]['start'] = int(
+                        max(0, speeches[i + 1]['start'] - speech_pad_samples))
+            else:
+                speech['end'] = int(
+                    min(self._length, speech['end'] + speech_pad_samples))
+        return speeches
+
+
+class Shadow:
+
+    LEAD = 100
+
+    def __init__(self, phrase, lead=LEAD, pause=None, key=None):
+        self._phrase = phrase
+        self._lead = lead
+        self._pause = len(phrase) if pause is None else pause
+        self._key = key
+
+    def __len__(self):
+        return self._lead + len(self._phrase) + self._pause
+
+    def __getitem__(self, key):
+        return self.segment()[key]
+
+    @property
+    def phrase(self):
+        return self._phrase
+
+    @property
+    def key(self):
+        return self._key
+
+    @property
+    def frame_rate(self):
+        return self._phrase.frame_rate
+
+    @property
+    def channels(self):
+        return self._phrase.channels
+
+    @property
+    def sample_width(self):
+        return self._phrase.sample_width
+
+    def parts(self):
+        return [self._lead, self._phrase, self._pause]
+
+    def segment(self):
+        def silent(duration):
+            return AudioSegment.silent(
+                duration=duration, frame_rate=self.frame_rate).set_channels(
+                self.channels).set_sample_width(self.sample_width)
+        return silent(self._lead) + self._phrase + silent(self._pause)
+
+    def pcm(self, silence):
+        for part in self.parts():
+            if isinstance(part, AudioSegment):
+                yield part.raw_data
+                continue
+            size = int(part * self.frame_rate / 1000) * \
+                self.channels * self.sample_width
+            while size > 0:
+                yield silence[:size]
+                size -= len(silence)
+
+
+class AudioEngine:
+
+    _XRUNS = {
+        "input_underflow": 0x1,
+        "input_overflow": 0x2,
+        "output_underflow": 0x4,
+        "output_overflow": 0x8,
+    }
+
+    def __init__(self, input_device=None, output_device=None, rate=44100,
+                 channels=1, frames_per_buffer=512, capacity=180, lag=None,
+                 backend=None, tracer=None):
+        self._input_device = input_device
+        self._output_device = output_device
+        self._rate = rate
+        self._channels = channels
+        self._frames_per_buffer = frames_per_buffer
+        self._lag = lag
+        # Any PyAudio-like module, e.g. a fake device for benchmarks.
+        self._backend = backend
+        self._tracer = tracer if tracer is not None else NullTracer()
+        self._pyaudio = None
+        self._stream = None
+        self._lock = threading.Lock()
+        # Input is kept continuously in a ring indexed by absolute stream
+        # frame, so a recording is just a range read once it is complete.
+        self._ring = np.zeros(capacity * rate, np.int16)
+        self._out = np.zeros(
+            (frames_per_buffer * 4, channels), np.int16)
+        self._frame = 0
+        self._playing = None
+        self._part = 0
+        self._position = 0
+        self._started = None
+        self._played = None
+        self._until = None
+        self._captured = None
+        self._xruns = dict.fromkeys(self._XRUNS, 0)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def xruns(self):
+        return dict(self._xruns)
+
+    @property
+    def latency(self):
+        if self._stream is None:
+            return {"input": None, "output": None}
+        return {"input": self._stream.get_input_latency(),
+                "output": self._stream.get_output_latency()}
+
+    @property
+    def lag(self):
+        if self._lag is not None:
+            return self._lag
+        latency = self.latency
+        if latency["input"] is None:
+            return 0
+        return round((latency["input"] + latency["output"]) * self._rate)
+
+    @property
+    def active(self):
+        return self._stream is not None and self._stream.is_active()
+
+    def open(self):
+        if self._backend is None:
+            import pyaudio
+            self._backend = pyaudio
+        pyaudio = self._backend
+        if self._stream is not None:
+            return
+        with self._tracer.span("open"):
+            self._pyaudio = pyaudio.PyAudio()
+            self._continue = pyaudio.paContinue
+            self._stream = self._pyaudio.open(
+                format=pyaudio.paInt16,
+                channels=self._channels,
+                rate=self._rate,
+                input=True,
+                output=True,
+                input_device_index=self._input_device,
+                output_device_index=self._output_device,
+                frames_per_buffer=self._frames_per_buffer,
+                stream_callback=self._callback)
+            self._stream.start_stream()
+
+    def close(self):
+        if self._stream is None:
+            return
+        with self._tracer.span("close", xruns=sum(self._xruns.values())):
+            self._stream.stop_stream()
+            self._stream.close()
+            self._pyaudio.terminate()
+            self._stream = None
+            self._pyaudio = None
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        if status:
+            for name, flag in self._XRUNS.items():
+                if status & flag:
+                    self._xruns[name] += 1
+        if len(self._out) < frame_count:
+            self._out = np.zeros((frame_count, self._channels), np.int16)
+        out = self._out[:frame_count]
+        out[:] = 0
+        with self._lock:
+            if self._playing is not None:
+                if self._started is None:
+                    self._started = self._frame
+                filled = 0
+                while filled < frame_count and self._part < len(self._playing):
+                    part = self._playing[self._part]
+                    # Pauses are frame counts: the zeroed buffer is the
+                    # silence.
+                    length = part if isinstance(part, int) else len(part)
+                    count = min(frame_count - filled,
+                                length - self._position)
+                    if not isinstance(part, int):
+                        out[filled:filled + count] = part[
+                            self._position:self._position + count]
+                    filled += count
+                    self._position += count
+                    if self._position >= length:
+                        self._part += 1
+                        self._position = 0
+                if self._part >= len(self._playing):
+                    self._playing = None
+                    self._played.set()
+            if in_data is not None:
+                self._write(np.frombuffer(in_data, np.int16)[
+                            ::self._channels])
+            self._frame += frame_count
+            if self._until is not None and self._frame >= self._until:
+                self._until = None
+                self._captured.set()
+        return out.tobytes(), self._continue
+
+    def _write(self, data):
+        index = self._frame % len(self._ring)
+        first = min(len(data), len(self._ring) - index)
+        self._ring[index:index + first] = data[:first]
+        self._ring[:len(data) - first] = data[first:]
+
+    def _read(self, start, end):
+        index = start % len(self._ring)
+        first = min(end - start, len(self._ring) - index)
+        return np.concatenate(
+            (self._ring[index:index + first],
+             self._ring[:end - start - first]))
+
+    def _wait(self, event):
+        while not event.wait(0.1):
+            if self._stream is None:
+                return False
+        return True
+
+    def play(self, segment, record=True):
+        parts = segment.parts() if isinstance(
+            segment, Shadow) else [segment]
+        program = []
+        for part in parts:
+            if isinstance(part, AudioSegment):
+                part = part.set_sample_width(2).set_frame_rate(
+                    self._rate).set_channels(self._channels)
+                program.append(np.frombuffer(part.raw_data, np.int16).reshape(
+                    -1, self._channels))
+            else:
+                program.append(int(part * self._rate / 1000))
+        length = sum(i if isinstance(i, int) else len(i) for i in program)
+        self.open()
+        lag = self.lag
+        if record and length + lag > len(self._ring):
+            raise ValueError("Segment is longer than the recording buffer")
+        played = threading.Event()
+        captured = threading.Event()
+        with self._lock:
+            self._played = played
+            self._captured = captured
+            self._started = None
+            self._part = 0
+            self._position = 0
+            self._playing = program
+        if not self._wait(played) or not record:
+            return None
+        # Capture the input frames that line up with what was played, once
+        # the round-trip latency has elapsed.
+        start = self._started + lag
+        with self._lock:
+            self._until = start + length
+            if self._frame >= self._until:
+                self._until = None
+                captured.set()
+        if not self._wait(captured):
+            return None
+        with self._lock:
+            data = self._read(start, start + length)
+        return AudioSegment(data=data.tobytes(), sample_width=2,
+                            frame_rate=self._rate, channels=1)
 
 
 class ShadowFormatter:
 
-    def __init__(self, speech_chunker):
+    _END = object()
+
+    def __init__(self, speech_chunker, lookahead=0, store=None, models=None,
+                 runtime=None, tracer=None):
         self._phrases = speech_chunker
+        self._models = models if models is not None else registry
+        self._runtime = runtime if runtime is not None else RuntimeConfig()
+        self._runtime.apply()
+        self._tracer = tracer if tracer is not None else NullTracer()
+        self._store = store if store is not None else SubtitleStore()
+        self._stored = {}
+        self._stored_digest = None
+        self._model_name = "silero_stt/en/" + self._runtime.options(
+            "silero_stt").get("jit_model", "jit_xlarge")
+        self._lookahead = lookahead
+        self._queue = None
+        self._worker = None
+        self._cancel = threading.Event()
+        self._stop_event = None
         self._output_device = 2
         self._input_device = 7
-        self._start_event = threading.Event()
-        self._model, self._decoder, self.utils = torch.hub.load(
-            'snakers4/silero-models', model='silero_stt', jit_model='jit_xlarge', language='en')
+        self._engine = None
+        self._subtitles = {}
+        self._subtitled = None
 
     def __iter__(self):
         return self
 
+    @property
+    def model(self):
+        return self._models.get(
+            "silero_stt", **self._runtime.options("silero_stt"))[0]
+
+    @property
+    def decoder(self):
+        return self._models.get(
+            "silero_stt", **self._runtime.options("silero_stt"))[1]
+
+    @property
+    def utils(self):
+        return self._models.get(
+            "silero_stt", **self._runtime.options("silero_stt"))[2]
+
     def __next__(self):
-        return self.format()
+        # stop() may run on another thread.
+        items, worker = self._queue, self._worker
+        if worker is None:
+            if self._stop_event is not None and self._stop_event.is_set():
+                raise StopIteration
+            return self.format()
+        while not self._cancelled():
+            try:
+                item = items.get(timeout=0.1)
+            except queue.Empty:
+                if not worker.is_alive() and items.empty():
+                    break
+                continue
+            if item is self._END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            return item
+        raise StopIteration
 
     def reset(self):
+        self.stop()
         self._phrases.reset()
 
+    def seek(self, index):
+        # Prefetched phrases are dropped, the next one is `index`.
+        running = self._worker is not None
+        self.stop()
+        self._phrases.phrases.seek(index)
+        if running:
+            self.start(self._stop_event)
+
+    @property
+    def lookahead(self):
+        return self._lookahead
+
+    @lookahead.setter
+    def lookahead(self, lookahead):
+        self._lookahead = lookahead
+
+    def start(self, stop_event=None):
+        self.stop()
+        self._stop_event = stop_event
+        if self._lookahead <= 0:
+            return
+        self._cancel = threading.Event()
+        self._queue = queue.Queue(maxsize=self._lookahead)
+        self._worker = threading.Thread(
+            target=self._prefetch, args=(
+                self._queue, self._cancel, stop_event), daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        if self._worker is None:
+            return
+        self._cancel.set()
+        self._worker.join()
+        self._worker = None
+        self._queue = None
+
+    def _cancelled(self, cancel=None, stop_event=None):
+        cancel = cancel or self._cancel
+        stop_event = stop_event or self._stop_event
+        return cancel.is_set() or (
+            stop_event is not None and stop_event.is_set())
+
+    def _produce(self):
+        try:
+            return self.format()
+        except StopIteration:
+            return self._END
+        except BaseException as e:
+            return e
+
+    def _prefetch(self, items, cancel, stop_event):
+        item = self._produce()
+        while not self._cancelled(cancel, stop_event):
+            try:
+                items.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            if item is self._END or isinstance(item, BaseException):
+                return
+            item = self._produce()
+
     @property
     def input_device(self):
-        return self._input
+        return self._input_device
 
     @input_device.setter
     def input_device(self, input_device):
         self._input_device = input_device
+        self.close()
 
     @property
     def output_device(self):
-        return self._output
+        return self._output_device
 
     @output_device.setter
     def output_device(self, output_device):
         self._output_device = output_device
+        self.close()
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self._tracer = tracer if tracer is not None else NullTracer()
+        self.close()
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = AudioEngine(
+                input_device=self._input_device,
+                output_device=self._output_device,
+                tracer=self._tracer)
+        return self._engine
+
+    def close(self):
+        if self._engine is not None:
+            self._engine.close()
+            self._engine = None
 
     def format(self):
-        shadow = AudioSegment.silent(duration=100)
+        # Per-phrase turnaround, from cutting the phrase to its subtitle.
+        started = time.perf_counter()
         i = next(self._phrases)
-        sub = self.subtitle(i)
-        shadow += i
-        shadow += AudioSegment.silent(duration=len(i))
-        return sub, shadow
+        source = "transcribed"
+        # A new index is built whenever the track is re-segmented.
+        if self._subtitled is self._phrases.phrases and \
+                self._phrases.index in self._subtitles:
+            sub = self._subtitles[self._phrases.index]
+        else:
+            sub = self.stored().get(self._phrases.bounds)
+            if sub is None:
+                source = "subtitle"
+                sub = self.subtitle(
+                    self._phrases.slice(*self._phrases.bounds))
+                self._stored[self._phrases.bounds] = sub
+                if self._phrases.digest is not None:
+                    self._store.put(self._phrases.digest,
+                                    *self._phrases.bounds,
+                                    self._model_name, sub)
+            else:
+                source = "store"
+        self._tracer.emit("format", time.perf_counter() - started,
+                          index=self._phrases.index, source=source)
+        key = None if self._phrases.digest is None else (
+            self._phrases.digest,) + tuple(self._phrases.bounds)
+        return sub, Shadow(i, key=key)
+
+    def export(self, path, format=None, block_size=1 << 16):
+        with self._tracer.span("export", path=path) as span:
+            self._export(path, format, block_size)
+            span["bytes"] = os.path.getsize(path)
+        return path
+
+    def _export(self, path, format=None, block_size=1 << 16):
+        if format is None:
+            format = os.path.splitext(path)[1].lstrip(".").lower()
+        phrases = self._phrases
+        if not phrases.phrases:
+            raise ValueError("No phrases to export")
+        # One phrase is held at a time and pauses are written from a single
+        # block of zeros, so memory does not depend on the track length.
+        silence = bytes(block_size)
+        shadows = (Shadow(phrases.phrase(i))
+                   for i in range(len(phrases.phrases)))
+        first = phrases.data if phrases.data is not None \
+            else phrases.phrase(0)
+
+        if format == "wav":
+            with wave.open(path, "wb") as f:
+                f.setnchannels(first.channels)
+                f.setsampwidth(first.sample_width)
+                f.setframerate(first.frame_rate)
+                for shadow in shadows:
+                    for block in shadow.pcm(silence):
+                        f.writeframesraw(block)
+            return path
+
+        options = {
+            "opus": ["-c:a", "libopus", "-ar", "48000", "-f", "ogg"],
+        }.get(format, ["-f", format])
+        encoder = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-y",
+             "-f", "s16le", "-ar", str(first.frame_rate),
+             "-ac", str(first.channels), "-i", "pipe:0"] + options + [path],
+            stdin=subprocess.PIPE)
+        try:
+            for shadow in shadows:
+                for block in shadow.pcm(silence):
+                    encoder.stdin.write(block)
+        finally:
+            encoder.stdin.close()
+            if encoder.wait() != 0:
+                raise RuntimeError("ffmpeg failed to encode {}".format(path))
+        return path
+
+    def timeline(self):
+        # Where each phrase starts and ends in the exported shadow track,
+        # counted in frames like export() writes them.
+        # Computed from the bounds, no phrase is decoded.
+        timeline = []
+        frames = 0
+        for i in range(len(self._phrases.phrases)):
+            rate, count = self._phrases.frames(i)
+            # A Shadow pauses for as long as its phrase, len() of the
+            # AudioSegment.
+            pause = round(1000 * count / rate)
+            frames += int(Shadow.LEAD * rate / 1000)
+            start = frames * 1000 / rate
+            frames += count
+            end = frames * 1000 / rate
+            frames += int(pause * rate / 1000)
+            timeline.append((start, end, frames * 1000 / rate))
+        return timeline
 
     def subtitle(self, segment):
-        audio = np.frombuffer(segment.raw_data, np.int16)
-        audio = audio.reshape(
-            len(audio) //
-            segment.channels,
-            segment.channels).mean(
-            axis=1)
-        audio = audio.astype(np.float32) / 32767.5
-        resampler = torchaudio.transforms.Resample(
-            orig_freq=segment.frame_rate, new_freq=16000)
-        audio = torch.tensor(audio).unsqueeze(0)
-        audio = resampler(audio)
-        input_audio = self.utils[3](audio)
-        transcriptions = self._model(input_audio)
-        return self._decoder(transcriptions[0].cpu())
-
-    def play_audio(self, p, segment):
-        self._start_event.wait()
-        audio_data = segment.raw_data
-        stream_out = p.open(format=p.get_format_from_width(segment.sample_width),
-                            channels=segment.channels,
-                            rate=segment.frame_rate,
-                            output_device_index=self._output_device,
-                            output=True)
-        stream_out.write(audio_data)
-        stream_out.stop_stream()
-        stream_out.close()
-
-    def record_audio(self, p, frames, duration):
-        self._start_event.wait()
-        start_time = time.time()
-        stream = p.open(format=pyaudio.paInt16,
-                        channels=1,
-                        frames_per_buffer=512,
-                        rate=44100,
-                        input_device_index=self._input_device,
-                        input=True)
-        while time.time() - start_time < duration / 1000:
-            input_audio = stream.read(512)
-            frames.append(input_audio)
-        stream.stop_stream()
-        stream.close()
+        audio = waveform(segment) if isinstance(
+            segment, AudioSegment) else segment
+        with self._tracer.span("subtitle", samples=audio.shape[-1]):
+            return self.recognize([audio])[0]
 
-    def play(self, segment):
-        # try:
-        p = pyaudio.PyAudio()
+    def recognize(self, audios):
+        input_audio = self.utils[3](audios)
+        with self._runtime.context():
+            transcriptions = self.model(input_audio)
+        return [self.decoder(i.cpu()) for i in transcriptions]
 
-        frames = []
-        record_thread = threading.Thread(
-            target=self.record_audio, args=(
-                p, frames, len(segment)))
-        play_thread = threading.Thread(
-            target=self.play_audio, args=(p, segment))
+    def stored(self):
+        digest = self._phrases.digest
+        if digest != self._stored_digest:
+            self._stored = {} if digest is None else self._store.lookup(
+                digest, self._model_name)
+            self._stored_digest = digest
+        return self._stored
 
-        record_thread.start()
-        play_thread.start()
-        self._start_event.set()
+    def transcribe(self, batch_size=32):
+        index = self._phrases.phrases
+        phrases = list(index)
+        stored = self.stored()
+        subtitles = {i: stored[bounds]
+                     for i, bounds in enumerate(phrases) if bounds in stored}
+        # Sort by duration so that each padded batch holds phrases of
+        # similar length.
+        order = sorted((i for i in range(len(phrases)) if i not in subtitles),
+                       key=lambda i: phrases[i][1] - phrases[i][0])
+        missing = {}
+        with self._tracer.span("transcribe", phrases=len(order)):
+            for j in range(0, len(order), batch_size):
+                batch = order[j:j + batch_size]
+                texts = self.recognize(
+                    [self._phrases.slice(*phrases[i]) for i in batch])
+                for i, text in zip(batch, texts):
+                    subtitles[i] = text
+                    missing[phrases[i]] = text
+        stored.update(missing)
+        if missing and self._phrases.digest is not None:
+            self._store.update(self._phrases.digest, self._model_name, missing)
+        self._subtitles = subtitles
+        self._subtitled = index
+        return subtitles
+
+    def play(self, segment):
+        # The whole capture, aligned with segment: SpeechComparator cuts the
+        # learner's attempt from its second half.
+        with self._tracer.span("play", duration_ms=len(segment)):
+            return self.engine.play(segment)
 
-        play_thread.join()
-        record_thread.join()
 
-        p.terminate()
-        self._start_event.clear()
+def dtw(x, y, radius=None):
+    # Cosine distances for every pair of frames in one matrix product.
+    x = x / (np.linalg.norm(x, axis=1, keepdims=True) + 1e-8)
+    y = y / (np.linalg.norm(y, axis=1, keepdims=True) + 1e-8)
+    cost = np.maximum(1 - x @ y.T, 0)
+    n, m = cost.shape
+    if radius is not None:
+        # Sakoe-Chiba band around the diagonal joining both ends.
+        centre = np.arange(n)[:, None] * ((m - 1) / max(n - 1, 1))
+        cost[np.abs(centre - np.arange(m)[None, :]) > max(radius, 1)] = np.inf
 
-        return AudioSegment(data=b''.join(frames[len(frames) // 2:]),
-                            sample_width=2, frame_rate=44100, channels=1)
-        # except BaseException:
-        #   pass
+    # Cells of an anti-diagonal only depend on the two previous ones, so
+    # each anti-diagonal is updated at once.
+    total = np.full((n + 1, m + 1), np.inf)
+    total[0, 0] = 0
+    for k in range(2, n + m + 1):
+        i = np.arange(max(1, k - m), min(n, k - 1) + 1)
+        j = k - i
+        total[i, j] = cost[i - 1, j - 1] + np.minimum(
+            np.minimum(total[i - 1, j - 1], total[i - 1, j]), total[i, j - 1])
+
+    i, j = n, m
+    path = [(i - 1, j - 1)]
+    while (i, j) != (1, 1):
+        steps = ((i - 1, j - 1), (i - 1, j), (i, j - 1))
+        i, j = min(steps, key=lambda step: total[step])
+        path.append((i - 1, j - 1))
+    return total[n, m], path[::-1]
 
 
 # TODO
 class SpeechComparator:
 
-    def __init__(self):
-        self._model = torchaudio.models.wav2vec2_large()
-        self._model.eval()
+    def __init__(self, models=None, radius=0.1, directory=None,
+                 max_entries=64, max_size=256 * 1024**2,
+                 model="wav2vec2_large", layer=4, runtime=None, tracer=None):
+        self._models = models if models is not None else registry
+        self._runtime = runtime if runtime is not None else RuntimeConfig()
+        self._runtime.apply()
+        self._tracer = tracer if tracer is not None else NullTracer()
+        self._radius = radius
+        if directory is None:
+            directory = os.path.join(cache_directory(), "features")
+        self._directory = directory
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._references = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._model_name = model
+        self._layer = layer
+
+    @property
+    def radius(self):
+        return self._radius
+
+    @radius.setter
+    def radius(self, radius):
+        self._radius = radius
+
+    @property
+    def layer(self):
+        return self._layer
+
+    @property
+    def tracer(self):
+        return self._tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self._tracer = tracer if tracer is not None else NullTracer()
+
+    @property
+    def model(self):
+        return self._models.get(
+            self._model_name, num_layers=self._layer + 1,
+            **self._runtime.options(self._model_name))
 
     def extract_features(self, segment):
-        audio = np.frombuffer(segment.raw_data, np.int16)
-        audio = audio.reshape(
-            len(audio) //
-            segment.channels,
-            segment.channels).mean(
-            axis=1)
-        audio = audio.astype(np.float32) / 32767.5
-        resampler = torchaudio.transforms.Resample(
-            orig_freq=segment.frame_rate, new_freq=16000)
-        audio = torch.tensor(audio).unsqueeze(0)
-        audio = resampler(audio)
-        features, _ = self._model.extract_features(waveforms=audio)
-        return features[4].squeeze(0)
+        audio = waveform(segment) if isinstance(
+            segment, AudioSegment) else segment
+        with self._tracer.span("features", samples=audio.shape[-1]), \
+                self._runtime.context():
+            features, _ = self.model.extract_features(
+                waveforms=audio.unsqueeze(0), num_layers=self._layer + 1)
+        return features[self._layer].squeeze(0)
 
     def preprocess(self, reference, audio):
         cut = len(reference) // 2
@@ -253,14 +2453,238 @@ class SpeechComparator:
     def normalize(self, feature):
         return (feature - feature.mean()) / (feature.std() + 1e-8)
 
-    def compare(self, reference, audio):
+    def _path(self, key):
+        digest, start, end = key
+        return os.path.join(
+            self._directory, digest, "{}{}-{}-{!r}-{!r}.npy".format(
+                self._model_name, "-int8" if self._runtime.quantize else "",
+                self._layer, start, end))
+
+    def extract_batch(self, audios):
+        import torch
+        # Only inputs of equal length are stacked: wav2vec2's group norm
+        # runs over time, so padding would change the features.
+        features = [None] * len(audios)
+        groups = collections.defaultdict(list)
+        for i, audio in enumerate(audios):
+            groups[audio.shape[-1]].append(i)
+        for indexes in groups.values():
+            with self._tracer.span("features", samples=audios[
+                    indexes[0]].shape[-1], batch=len(indexes)), \
+                    self._runtime.context():
+                batch, _ = self.model.extract_features(
+                    waveforms=torch.stack([audios[i] for i in indexes]),
+                    num_layers=self._layer + 1)
+            for i, feature in zip(indexes, batch[self._layer]):
+                features[i] = self.normalize(feature)
+        return features
+
+    def cached(self, key):
+        import torch
+        with self._lock:
+            features = self._references.get(key)
+            if features is not None:
+                self._references.move_to_end(key)
+                return features
+        path = self._path(key)
+        try:
+            features = torch.from_numpy(np.load(path).astype(np.float32))
+        except FileNotFoundError:
+            return None
+        # File mtimes are the LRU clock of evict().
+        now = time.time_ns()
+        try:
+            os.utime(path, ns=(now, now))
+        except FileNotFoundError:
+            pass
+        self.remember(key, features)
+        return features
+
+    def remember(self, key, features):
+        path = self._path(key)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".{}.tmp".format(os.getpid())
+            with open(tmp, "wb") as f:
+                np.save(f, features.numpy().astype(np.float16))
+            os.replace(tmp, path)
+            self.evict()
+        with self._lock:
+            self._references[key] = features
+            while len(self._references) > self._max_entries:
+                self._references.popitem(last=False)
+
+    @property
+    def max_size(self):
+        return self._max_size
+
+    @max_size.setter
+    def max_size(self, max_size):
+        self._max_size = max_size
+        self.evict()
+
+    def evict(self):
+        files = []
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                if not name.endswith(".npy"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size,
+                              os.path.join(root, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self._max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def reference_features(self, reference, key=None):
+        if key is None:
+            return self.normalize(self.extract_features(reference))
+        features = self.cached(key)
+        if features is None:
+            features = self.normalize(self.extract_features(reference))
+            self.remember(key, features)
+        return features
+
+    def key(self, chunker, index):
+        if chunker.digest is None:
+            return None
+        return (chunker.digest,) + tuple(chunker.phrases[index])
+
+    def precompute(self, speech_chunker):
+        for i in range(len(speech_chunker.phrases)):
+            key = self.key(speech_chunker, i)
+            if key is None or os.path.isfile(self._path(key)):
+                continue
+            shadow = Shadow(speech_chunker.phrase(i))
+            self.reference_features(shadow[:len(shadow) // 2], key)
+
+    def compare(self, reference, audio, key=None):
+        with self._tracer.span("compare", keyed=key is not None):
+            return self._compare(reference, audio, key)
+
+    def _compare(self, reference, audio, key=None):
         reference, audio = self.preprocess(reference, audio)
-        reference = self.normalize(self.extract_features(reference))
+        reference = self.reference_features(reference, key)
         audio = self.normalize(self.extract_features(audio))
+        return self.score(reference, audio)
+
+    def score(self, reference, audio):
+        import torch
         if (diff := reference.shape[0] - audio.shape[0]) < 0:
             audio = audio[:len(reference)]
         elif diff > 0:
-            audio = torch.nn.functional.pad(audio, (diff, 0))
-        distance, path = fastdtw(reference.detach().numpy(
-        ).T, audio.detach().numpy().T, dist=scipy.spatial.distance.cosine)
+            # Frames are padded at the start, features are the last axis.
+            audio = torch.nn.functional.pad(audio, (0, 0, diff, 0))
+        reference = reference.detach().numpy().T
+        audio = audio.detach().numpy().T
+        radius = None if self._radius is None else int(
+            np.ceil(self._radius * max(len(reference), len(audio))))
+        with self._tracer.span("dtw", shape=reference.shape):
+            distance, path = dtw(reference, audio, radius)
         return 1 / (1 + distance)
+
+
+class ScoringService:
+
+    def __init__(self, comparator=None, max_pending=2, workers=1):
+        self._comparator = comparator if comparator is not None \
+            else SpeechComparator()
+        self._max_pending = max_pending
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._dropped = 0
+        self._closed = False
+        self._workers = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def comparator(self):
+        return self._comparator
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    def submit(self, reference, audio, key=None, callback=None,
+               on_error=None):
+        if key is None:
+            key = getattr(reference, "key", None)
+        future = concurrent.futures.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Scoring service is closed")
+            generation = self._generation
+
+            def done(future):
+                # Attempts skipped while being scored report nothing.
+                if future.cancelled() or generation != self._generation:
+                    return
+                if future.exception() is None:
+                    if callback is not None:
+                        callback(future.result())
+                elif on_error is not None:
+                    on_error(future.exception())
+            future.add_done_callback(done)
+            # Backpressure: the oldest waiting attempt gives way to the
+            # newest one.
+            while len(self._pending) >= self._max_pending:
+                self._pending.popleft()[-1].cancel()
+                self._dropped += 1
+            self._pending.append(
+                (self._generation, reference, audio, key, future))
+            self._condition.notify()
+        return future
+
+    def skip(self):
+        with self._condition:
+            self._generation += 1
+            while self._pending:
+                self._pending.popleft()[-1].cancel()
+                self._dropped += 1
+
+    def close(self):
+        self.skip()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                generation, reference, audio, key, future = \
+                    self._pending.popleft()
+                stale = generation != self._generation
+            if stale:
+                future.cancel()
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(
+                    self._comparator.compare(reference, audio, key))
+            except BaseException as e:
+                future.set_exception(e)
@@ -2,12 +2,45 @@ import torch
 from pydub import AudioSegment
 import zipfile
 import torchaudio
-from glob import glob
-from speech_chunker import SpeechChunker, ShadowFormatter, SpeechComparator
+import os
+import sys
+import subprocess
+import threading
+import json
+import speech_chunker
+import bench
+import batch
+import scheduler
+import server
+from speech_chunker import AudioCache, AudioEngine, JsonLinesSink, NullTracer, PhraseIndex, Tracer, ModelRegistry, RuntimeConfig, ScoringService, Shadow, SubtitleStore, SpeechChunker, ShadowFormatter, SpeechComparator
 import numpy as np
 import pytest
 
 
+IMPORT_BUDGET = 0.5
+
+
+def test_import_time(tmp_path):
+    # The GUIs build these on the main thread before the window shows.
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import speech_chunker\n"
+        "chunker = speech_chunker.SpeechChunker()\n"
+        "speech_chunker.ShadowFormatter(chunker)\n"
+        "speech_chunker.SpeechComparator()\n"
+        "print(time.perf_counter() - start)\n"
+        "print(sorted(set(sys.modules) & {'torch', 'torchaudio', 'yt_dlp', "
+        "'pyaudio', 'fastdtw', 'scipy'}))\n")
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True,
+        check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=dict(os.environ, ECHOMASTER_CACHE=str(tmp_path))).stdout
+    duration, modules = output.splitlines()
+    assert modules == "[]"
+    assert float(duration) < IMPORT_BUDGET
+
+
 def test_stt():
     bc = SpeechChunker()
     bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
@@ -16,22 +49,186 @@ def test_stt():
 
     (read_batch, split_into_batches,
      read_audio, prepare_model_input) = ft.utils
-    test_files = glob('data.m4a')
+    test_files = [bc.source]
     batches = split_into_batches(test_files, batch_size=100)
     input = prepare_model_input(read_batch(batches[0]))
 
-    reference_output = ft._decoder(ft._model(input)[0].cpu())
-    test_output = ft.subtitle(bc._data)
+    reference_output = ft.decoder(ft.model(input)[0].cpu())
+    test_output = ft.subtitle(bc._data[:])
     assert reference_output == test_output
 
 
+def test_transcribe(tmp_path):
+    bc = synthetic_chunker(tmp_path)
+    ft = ShadowFormatter(bc, store=SubtitleStore(":memory:"))
+
+    subtitles = ft.transcribe(batch_size=4)
+    assert sorted(subtitles) == list(range(len(bc.phrases)))
+    start, end = bc.phrases[0]
+    assert subtitles[0] == ft.subtitle(bc.slice(start, end))
+    assert next(ft)[0] == subtitles[0]
+
+
+def test_prefetch(tmp_path):
+    bc = synthetic_chunker(tmp_path)
+    ft = ShadowFormatter(bc, store=SubtitleStore(":memory:"))
+    reference_output = [s for s, _ in ft]
+
+    ft.reset()
+    ft.lookahead = 3
+    ft.start()
+    assert [s for s, _ in ft] == reference_output
+
+    ft.reset()
+    stop_event = threading.Event()
+    ft.start(stop_event)
+    next(ft)
+    stop_event.set()
+    with pytest.raises(StopIteration):
+        next(ft)
+
+
+def test_registry():
+    models = ModelRegistry()
+    bc = SpeechChunker(models=models)
+    cp = SpeechComparator(models=models)
+    assert not models.loaded("wav2vec2_large")
+    assert bc.model is SpeechChunker(models=models).model
+    assert list(models.timings) == [("silero_vad", ())]
+    assert cp.model is models.get("wav2vec2_large", num_layers=5)
+
+
+def test_mapped_audio(tmp_path):
+    reference = bench.synthetic_speech(120)
+    reference.export(tmp_path / "audio.wav", format="wav")
+    audio = speech_chunker.MappedAudio(str(tmp_path / "audio.wav"))
+
+    assert len(audio) == len(reference)
+    assert audio[1234:5678] == reference[1234:5678]
+    assert audio.frames(1234.5, 5678.9) == audio[1234.5:5678.9].frame_count()
+    assert audio.frames(119000, 125000) == audio[119000:125000].frame_count()
+    resampled = audio.resample(str(tmp_path / "audio16k.f32"))
+    assert resampled.shape[-1] == torchaudio.transforms.Resample(
+        reference.frame_rate, 16000)(torch.zeros(1, audio.frame_count)).shape[-1]
+    expected = speech_chunker.waveform(reference[60000:90000])
+    assert torch.allclose(
+        resampled[60000 * 16:90000 * 16][100:-100], expected[100:-100], atol=1e-4)
+
+
+def test_ingest(tmp_path):
+    reference = bench.synthetic_speech(30)
+    reference.export(tmp_path / "speech.wav", format="wav")
+    cache = AudioCache(tmp_path / "cache")
+
+    bc = SpeechChunker(cache=cache)
+    bc.ingest(tmp_path / "speech.wav")
+    assert bc.phrases and not os.path.exists(
+        os.path.join(bc._entry, "audio.wav"))
+    start, end = bc.phrases[0]
+    assert bc.phrase(0) == reference[start:end]
+    expected = speech_chunker.waveform(reference)
+    assert abs(bc.waveform.shape[-1] - expected.shape[-1]) <= 16
+    n = min(bc.waveform.shape[-1], expected.shape[-1])
+    assert (bc.waveform[:n] - expected[:n]).norm() < 0.05 * expected.norm()
+
+    with open(tmp_path / "speech.wav", "rb") as f:
+        piped = SpeechChunker(cache=cache)
+        piped.ingest(f)
+    assert piped.phrases == bc.phrases and piped.digest == bc.digest
+    assert piped.phrase(0) == bc.phrase(0)
+
+
+def test_stream(tmp_path):
+    bc = SpeechChunker(cache=AudioCache(tmp_path))
+    bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
+    bc.load(stream=True)
+    phrases = list(bc)
+    assert phrases
+    assert [len(i) for i in phrases] == pytest.approx(
+        [end - start for start, end in bc.phrases], abs=1)
+    assert all(end - start <= bc.chunk_duration *
+               1000 for start, end in bc.phrases)
+    # The finished stream is published to the cache and played from there.
+    assert bc.cache.get(AudioCache.key(bc.url)) is not None
+    assert bc.digest is not None and bc.phrase(0).frame_rate != 16000
+
+
+def test_stream_error(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", str(tmp_path))
+    bc = SpeechChunker(cache=AudioCache(tmp_path / "cache"))
+    bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
+    bc.load(stream=True)
+    with pytest.raises(OSError):
+        next(bc)
+    bc.cancel()
+    assert os.listdir(tmp_path / "cache") == []
+
+
+def fake_yt_dlp(tmp_path, monkeypatch, status=0):
+    # Streams synthetic speech after a short delay and exits with status.
+    source = tmp_path / "source.wav"
+    bench.synthetic_speech(30, channels=1).export(source, format="wav")
+    (tmp_path / "yt_dlp").mkdir()
+    (tmp_path / "yt_dlp" / "__init__.py").write_text("")
+    (tmp_path / "yt_dlp" / "__main__.py").write_text(
+        "import shutil, sys, time\n"
+        "time.sleep(0.5)\n"
+        "with open({!r}, 'rb') as f:\n"
+        "    shutil.copyfileobj(f, sys.stdout.buffer)\n"
+        "sys.exit({})\n".format(str(source), status))
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+
+
+def test_stream_rechunk(tmp_path, monkeypatch):
+    fake_yt_dlp(tmp_path, monkeypatch)
+    bc = SpeechChunker(40, cache=AudioCache(tmp_path / "cache"))
+    bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
+    bc.load(stream=True)
+    # Applied once the stream is published.
+    bc.chunk_duration = 5
+    list(bc)
+    assert bc.data is not None and len(bc.phrases) > 0
+    assert all(end - start <= 5000 for start, end in bc.phrases)
+
+
+def test_stream_failure(tmp_path, monkeypatch):
+    # yt_dlp fails after sending part of the audio.
+    fake_yt_dlp(tmp_path, monkeypatch, status=1)
+    bc = SpeechChunker(cache=AudioCache(tmp_path / "cache"))
+    bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
+    bc.load(stream=True)
+    phrases = []
+    with pytest.raises(RuntimeError):
+        for phrase in bc:
+            phrases.append(phrase)
+    assert phrases and len(phrases) == len(bc.phrases)
+    assert len(bc.slice(*bc.phrases[0])) > 0
+    bc.cancel()
+    assert os.listdir(tmp_path / "cache") == []
+
+
+def test_export(tmp_path):
+    bc = synthetic_chunker(tmp_path)
+    ft = ShadowFormatter(bc, store=SubtitleStore(":memory:"))
+
+    shadows = [Shadow(bc.phrase(i)) for i in range(len(bc.phrases))]
+    reference = sum((i.segment() for i in shadows[1:]), shadows[0].segment())
+    assert len(shadows[0]) == len(shadows[0].segment())
+
+    export = AudioSegment.from_wav(ft.export(str(tmp_path / "shadow.wav")))
+    assert export.raw_data == reference.raw_data
+    export = AudioSegment.from_file(ft.export(str(tmp_path / "shadow.flac")))
+    assert export.raw_data == reference.raw_data
+    assert ft.export(str(tmp_path / "shadow.opus"))
+
+
 def test_vad():
     bc = SpeechChunker()
     bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
     bc.load()
 
     (get_speech_timestamps, _, read_audio, _, _) = bc.utils
-    wav = read_audio('data.m4a')
+    wav = read_audio(bc.source)
     reference_output = [
         (i["start"] *
          1000,
@@ -46,10 +243,82 @@ def test_vad():
             min_speech_duration_ms=1000,
             max_speech_duration_s=bc._chunk_duration,
             min_silence_duration_ms=50)]
-    test_output = bc._phrases
+    test_output = bc.phrases
     assert reference_output == list(test_output)
 
 
+def synthetic_chunker(tmp_path, duration=30):
+    # Nothing is downloaded or written to the user's cache.
+    bench.synthetic_speech(duration).export(
+        tmp_path / "speech.wav", format="wav")
+    bc = SpeechChunker(cache=AudioCache(tmp_path / "cache"))
+    bc.ingest(tmp_path / "speech.wav")
+    return bc
+
+
+def test_rechunk(tmp_path):
+    bc = synthetic_chunker(tmp_path, 60)
+    probs = bc._probs
+    bc.chunk_duration = 5
+    assert bc._probs is probs
+
+    get_speech_timestamps = bc.utils[0]
+    reference_output = [
+        (i["start"] *
+         1000,
+         i["end"] *
+            1000) for i in get_speech_timestamps(
+            bc.waveform,
+            bc.model,
+            sampling_rate=16000,
+            threshold=0.2,
+            return_seconds=True,
+            speech_pad_ms=80,
+            min_speech_duration_ms=1000,
+            max_speech_duration_s=5,
+            min_silence_duration_ms=50)]
+    assert reference_output == list(bc.phrases)
+
+
+def test_phrase_index():
+    bounds = [(0.0, 1000.0), (1500.0, 3000.0), (3000.0, 4000.0),
+              (6000.0, 9000.0)]
+    index = PhraseIndex(bounds)
+    assert len(index) == 4 and index[1] == (1500.0, 3000.0)
+    assert index == bounds and index[-1] == bounds[-1]
+    assert [index.at(i) for i in (0, 1200, 3000, 5000, 10000)] == [
+        0, 0, 2, 2, 3]
+
+    assert list(iter(lambda: next(index, None), None)) == bounds
+    assert index.index == 3
+    index.rewind()
+    assert next(index) == bounds[0] and index.index == 0
+
+    index.seek(2)
+    index.loop = True
+    assert [next(index) for _ in range(3)] == [bounds[2]] * 3
+    index.loop = False
+    assert next(index) == bounds[3]
+    with pytest.raises(StopIteration):
+        next(index)
+
+    index.select(1, 3)
+    assert list(iter(lambda: next(index, None), None)) == bounds[1:3]
+    with pytest.raises(IndexError):
+        index.seek(0)
+    index.select(shuffle=True, seed=0)
+    order = [next(index) for _ in range(4)]
+    assert sorted(order) == bounds and not index.pending()
+    index.seek(bounds.index(order[1]))
+    assert next(index) == order[1]
+
+    streamed = PhraseIndex()
+    for i in range(100):
+        streamed.append(i * 100.0, i * 100.0 + 50)
+        assert next(streamed) == (i * 100.0, i * 100.0 + 50)
+    assert not streamed.pending() and len(streamed) == 100
+
+
 def add_noise(audio, mean=0, noise=1):
     data = np.frombuffer(audio.raw_data, np.int16).copy().astype(np.float64)
     data += np.random.normal(mean *
@@ -59,14 +328,534 @@ def add_noise(audio, mean=0, noise=1):
                         sample_width=audio.sample_width, frame_rate=audio.frame_rate, channels=audio.channels)
 
 
+def test_dtw():
+    def reference_dtw(x, y, radius):
+        x = x / np.linalg.norm(x, axis=1, keepdims=True)
+        y = y / np.linalg.norm(y, axis=1, keepdims=True)
+        cost = 1 - x @ y.T
+        n, m = cost.shape
+        total = np.full((n + 1, m + 1), np.inf)
+        total[0, 0] = 0
+        for i in range(1, n + 1):
+            for j in range(1, m + 1):
+                if abs((i - 1) * (m - 1) / (n - 1) - (j - 1)) <= radius:
+                    total[i, j] = cost[i - 1, j - 1] + min(
+                        total[i - 1, j - 1], total[i - 1, j], total[i, j - 1])
+        return total[n, m]
+
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(37, 8))
+    y = rng.normal(size=(61, 8))
+    distance, path = speech_chunker.dtw(x, y, radius=4)
+    assert distance == pytest.approx(reference_dtw(x, y, 4))
+    assert path[0] == (0, 0) and path[-1] == (36, 60)
+    assert all(0 <= i2 - i1 <= 1 and 0 <= j2 - j1 <= 1
+               for (i1, j1), (i2, j2) in zip(path, path[1:]))
+    assert speech_chunker.dtw(x, x)[0] == pytest.approx(0, abs=1e-6)
+
+    # Attempts shorter than the reference are padded in time.
+    cp = SpeechComparator()
+    reference, attempt = torch.randn(50, 16), torch.randn(49, 16)
+    assert cp.score(reference, attempt) == pytest.approx(cp.score(
+        reference, torch.cat([torch.zeros(1, 16), attempt])))
+
+
 def test_comparator():
     bc = SpeechChunker()
     bc.url = "https://www.youtube.com/watch?v=8LLMbDXdyRI"
     bc.load()
     cp = SpeechComparator()
 
-    assert cp.compare(bc._data, bc._data) > 0.9
-    assert np.abs(cp.compare(bc._data, bc._data.reverse())) < 0.1
+    data = bc._data[:]
+    assert cp.compare(data, data) > 0.9
+    assert np.abs(cp.compare(data, data.reverse())) < 0.1
+
+    audio = add_noise(data, noise=1e-2)
+    assert cp.compare(data, audio) > 0.9
+
+
+def test_cache(tmp_path):
+    cache = AudioCache(tmp_path, max_size=1000)
+    assert cache.key("https://www.youtube.com/watch?v=8LLMbDXdyRI") == "8LLMbDXdyRI"
+    assert cache.key("https://youtu.be/8LLMbDXdyRI") == "8LLMbDXdyRI"
+    assert cache.key("https://example.com/a b") != cache.key("https://example.com/a c")
+
+    def build(size):
+        def inner(directory):
+            with open(os.path.join(directory, "audio.wav"), "wb") as f:
+                f.write(bytes(size))
+        return inner
+
+    os.makedirs(tmp_path / "features")
+    first = cache.put("first", build(400))
+    second = cache.put("second", build(400))
+    assert cache.get("first") == first
+    cache.put("third", build(400))
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+    assert cache.put("first", build(10)) == first
+
+    lease = cache.lease(first)
+    cache.get("third")
+    cache.put("fourth", build(400))
+    cache.max_size = 400
+    assert cache.get("third") is None and cache.get("fourth") is None
+    assert cache.get("first") == first
+    lease.close()
+    cache.max_size = 0
+    assert cache.get("first") is None
+    assert cache.lease(first) is None
+    # Only audio entries are evicted.
+    assert os.listdir(tmp_path) == ["features"]
+    assert os.listdir(tmp_path / "features") == []
+
+
+def test_feature_store(tmp_path):
+    cp = SpeechComparator(directory=tmp_path, max_entries=1, max_size=1200)
+    keys = [(digest * 40, 0.0, 1000.0) for digest in "abc"]
+    for key in keys:
+        cp.remember(key, torch.zeros(100, 2))
+    assert cp.cached(keys[0]) is None
+    assert cp.cached(keys[1]) is not None and cp.cached(keys[2]) is not None
+    cp.max_size = 0
+    assert cp.cached(keys[2]) is not None
+    cp.remember(keys[0], torch.zeros(100, 2))
+    assert not any(i.endswith(".npy") for _, _, files in os.walk(tmp_path)
+                   for i in files)
+
+
+def test_subtitle_store(tmp_path):
+    store = SubtitleStore(tmp_path / "subtitles.sqlite", max_entries=3)
+    store.put("a", 0.0, 1100.0000000000002, "model", "hello")
+    store.update("a", "model", {(2000.0, 3000.0): "world"})
+    store.put("a", 0.0, 1100.0000000000002, "other", "bonjour")
+    assert store.get("a", 0.0, 1100.0000000000002, "model") == "hello"
+    assert store.get("b", 0.0, 1100.0000000000002, "model") is None
+    assert store.lookup("a", "model") == {
+        (0.0, 1100.0000000000002): "hello", (2000.0, 3000.0): "world"}
+
+    store.put("b", 0.0, 1000.0, "model", "again")
+    assert len(store.lookup("a", "model")) + \
+        len(store.lookup("a", "other")) + len(store.lookup("b", "model")) == 3
+
+
+def test_cache_hit(tmp_path):
+    bench.synthetic_speech(30).export(tmp_path / "speech.wav", format="wav")
+    bc = SpeechChunker(cache=AudioCache(tmp_path / "cache"))
+    bc.url = str(tmp_path / "speech.wav")
+    bc.download()
+    reference = bc._data[:]
+
+    bc = SpeechChunker(cache=AudioCache(tmp_path / "cache"))
+    bc.url = str(tmp_path / "speech.wav")
+    bc._fetch = None
+    bc.download()
+    assert bc._data[:] == reference
+
+
+def test_reference_features(tmp_path):
+    bc = synthetic_chunker(tmp_path)
+    cp = SpeechComparator(directory=tmp_path / "features", max_entries=2)
+    cp.precompute(bc)
+    assert len(list((tmp_path / "features" / bc.digest).iterdir())) == \
+        len(bc.phrases)
+
+    shadow = Shadow(bc.phrase(0))
+    key = cp.key(bc, 0)
+    cp.extract_features = None
+    features = cp.reference_features(shadow[:len(shadow) // 2], key)
+    assert cp.reference_features(None, key) is features
+
+
+def test_scoring_service():
+    release = threading.Event()
+
+    class Comparator:
+        def compare(self, reference, audio, key=None):
+            release.wait()
+            if audio is None:
+                raise ValueError("empty attempt")
+            return reference + audio
+
+    scores = []
+    service = ScoringService(Comparator(), max_pending=2)
+    running = service.submit(1, 1)
+    while not running.running():
+        pass
+    dropped = service.submit(1, 2)
+    kept = [service.submit(1, 3), service.submit(1, 4, callback=scores.append)]
+    assert dropped.cancelled() and service.dropped == 1
+
+    release.set()
+    assert running.result() == 2
+    assert [i.result() for i in kept] == [4, 5]
+    assert scores == [5]
+
+    release.clear()
+    running = service.submit(2, 2, callback=scores.append)
+    while not running.running():
+        pass
+    stale = service.submit(2, 3)
+    service.skip()
+    release.set()
+    assert stale.cancelled() and running.result() == 4
+    # The attempt was skipped while being scored, its score is not shown.
+    assert scores == [5]
+
+    errors = []
+    failed = threading.Event()
+    service.submit(1, None, on_error=lambda e: (errors.append(e), failed.set()))
+    assert failed.wait(5)
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    service.close()
+
+
+def test_shadow_attempt():
+    ft = ShadowFormatter(None, store=SubtitleStore(":memory:"))
+    ft._engine = AudioEngine(backend=bench.Loopback(delay=100))
+    shadow = Shadow(bench.synthetic_speech(3, channels=1))
+    record = ft.play(shadow)
+    reference, attempt = SpeechComparator().preprocess(shadow, record)
+    assert len(record) == len(shadow)
+    assert len(attempt) == len(shadow) - len(reference) > 0
+    ft.close()
+
+
+def test_formatter_stop():
+    ft = ShadowFormatter(None, lookahead=2, store=SubtitleStore(":memory:"))
+    ft.format = lambda: ("hello", None)
+    stop_event = threading.Event()
+    ft.start(stop_event)
+    assert next(ft) == ("hello", None)
+    stop_event.set()
+    assert list(ft) == []
+
+    ft.lookahead = 0
+    ft.start(stop_event)
+    assert list(ft) == []
+    stop_event.clear()
+    assert next(ft) == ("hello", None)
+
+    errors = []
+    stopped = threading.Event()
+
+    def consume():
+        # Iterating after stop() goes on synchronously.
+        try:
+            while not stopped.is_set():
+                next(ft)
+        except StopIteration:
+            pass
+        except Exception as e:
+            errors.append(e)
+
+    ft.lookahead = 2
+    ft.start(stop_event)
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    ft.stop()
+    stopped.set()
+    consumer.join()
+    assert errors == []
+
+
+def test_audio_engine():
+    segment = bench.synthetic_speech(3, channels=1)
+    with AudioEngine(backend=bench.Loopback(delay=1000)) as engine:
+        record = engine.play(segment)
+        assert engine.lag == 1000
+    assert record.raw_data == segment.raw_data
+
+
+def test_bench_regressions(tmp_path, monkeypatch):
+    baseline = {"stages": {"process": {"seconds": 1.0},
+                           "compare": {"seconds": 1.0},
+                           "export": {"seconds": 1.0},
+                           "dtw": {"seconds": 1.0},
+                           "format": {"skipped": "no model"}}}
+    results = {"stages": {"process": {"seconds": 1.1},
+                          "compare": {"seconds": 1.5},
+                          "subtitle": {"skipped": "no model"},
+                          "format": {"skipped": "no model"},
+                          "export": {"error": "RuntimeError: broken"}}}
+    assert bench.regressions(results, baseline, 0.2) == {
+        "compare": 1.5, "export": "error: RuntimeError: broken",
+        "dtw": "missing"}
+
+    # Stages run on their own still have phrases, and only a model that
+    # cannot be loaded is a skip.
+    def broken(*args):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(bench, "dtw", broken)
+    benchmark = bench.Benchmark(duration=20, repeat=1, phrases=2,
+                                models=ModelRegistry(str(tmp_path)))
+    results = benchmark.run(["segment", "dtw", "audio_io"])
+    assert "skipped" in results["segment"] and "skipped" in results["audio_io"]
+    assert "error" in results["dtw"]
+
+
+def test_tracer(tmp_path):
+    events = []
+    tracer = Tracer(events.append, window=4)
+    segment = bench.synthetic_speech(1, channels=1)
+    with AudioEngine(backend=bench.Loopback(), tracer=tracer) as engine:
+        engine.play(segment)
+    assert [i["name"] for i in events] == ["open", "close"]
+    assert events[1]["xruns"] == 0 and events[1]["peak_memory"] > 0
+
+    for i in range(10):
+        with tracer.span("phrase", index=i) as span:
+            span["bytes"] = i
+    assert events[-1]["index"] == 9 and events[-1]["bytes"] == 9
+    assert set(tracer.percentiles("phrase", (50, 99))) == {50, 99}
+    assert tracer.percentiles("missing") == {}
+    with pytest.raises(ValueError):
+        with tracer.span("failed"):
+            raise ValueError
+    assert events[-1]["error"] == "ValueError"
+
+    with JsonLinesSink(tmp_path / "trace.jsonl") as sink:
+        Tracer(sink).emit("stage", 0.5, bytes=10)
+    with open(tmp_path / "trace.jsonl") as f:
+        assert json.loads(f.read())["bytes"] == 10
+
+    null = NullTracer()
+    with null.span("phrase") as span:
+        span["bytes"] = 1
+    assert null.percentiles("phrase") == {}
+
+
+def test_batch(tmp_path):
+    entries = [(100, 2500.4, "hello"), (3723004, 3725000, "world")]
+    assert batch.srt(entries) == (
+        "1\n00:00:00,100 --> 00:00:02,500\nhello\n\n"
+        "2\n01:02:03,004 --> 01:02:05,000\nworld\n\n")
+    assert batch.vtt(entries).startswith(
+        "WEBVTT\n\n00:00:00.100 --> 00:00:02.500\nhello\n")
+
+    manifest = batch.Manifest(str(tmp_path / "manifest.json"))
+    manifest.update("a", status="done")
+    manifest.update("b", status="failed")
+    resumed = batch.Manifest(str(tmp_path / "manifest.json"))
+    assert resumed.done("a") and not resumed.done("b")
+    assert not resumed.done("c") and len(resumed) == 2
+
+
+def test_scheduler():
+    dispatched = []
+
+    def dispatch(function, *args):
+        dispatched.append(threading.current_thread().name)
+        function(*args)
+
+    release = threading.Event()
+    started = threading.Event()
+    order = []
+
+    def slow(job, value):
+        started.set()
+        release.wait()
+        order.append(value)
+        return value
+
+    def fast(job, value):
+        job.progress("step")
+        order.append(value)
+        return value
+
+    done, progress, errors = [], [], []
+    with scheduler.JobScheduler(dispatch, workers=4) as jobs:
+        first = jobs.submit("load", slow, 1, lane="chunker",
+                            on_done=done.append)
+        started.wait()
+        superseded = jobs.submit("rechunk", fast, 2, lane="chunker",
+                                 on_done=done.append)
+        latest = jobs.submit("rechunk", fast, 3, lane="chunker",
+                             on_done=done.append, on_progress=progress.append)
+        assert jobs.busy("chunker") and not jobs.busy("other")
+        release.set()
+        assert latest.result() == 3
+        assert superseded.cancelled and first.result() == 1
+
+        def fail(job):
+            raise ValueError("broken")
+        failed = jobs.submit("fail", fail, on_error=errors.append)
+        with pytest.raises(ValueError):
+            failed.result()
+
+        def cancelled(job):
+            job.cancel()
+            job.progress("never")
+        with pytest.raises(scheduler.Cancelled):
+            jobs.submit("cancel", cancelled, on_error=errors.append).result()
+
+    # Jobs of a lane run in submission order, superseded ones never run.
+    assert order == [1, 3]
+    assert sorted(done) == [1, 3] and progress == ["step"]
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    assert dispatched
+
+
+def test_dynamic_batcher():
+    batches = []
+
+    def double(items):
+        batches.append(len(items))
+        return [2 * i for i in items]
+
+    batcher = server.DynamicBatcher(double, max_batch_size=4, max_wait=0.5)
+    futures = [batcher.submit(i) for i in range(6)]
+    assert [i.result() for i in futures] == [2 * i for i in range(6)]
+    assert batches == [4, 2]
+    assert batcher.stats == {"batches": 2, "items": 6}
+
+    def fail(items):
+        raise ValueError("broken")
+    failing = server.DynamicBatcher(fail)
+    with pytest.raises(ValueError):
+        failing(1)
+
+    def check(items):
+        return [ValueError(i) if i < 0 else i for i in items]
+    checking = server.DynamicBatcher(check, max_wait=0.5)
+    futures = [checking.submit(i) for i in (1, -1, 2)]
+    assert futures[0].result() == 1 and futures[2].result() == 2
+    with pytest.raises(ValueError):
+        futures[1].result()
+    checking.close()
+    batcher.close()
+    failing.close()
+
+
+def test_server(tmp_path):
+    class Recognizer:
+        _model_name = "fake"
+
+        def recognize(self, audios):
+            return [str(i.shape[-1]) for i in audios]
+
+    cp = SpeechComparator(models=ModelRegistry(), model="wav2vec2_base",
+                          layer=2, directory=str(tmp_path / "features"))
+    references = [torch.randn(16000) for _ in range(4)]
+    attempts = [torch.randn(16000) for _ in range(4)]
+    address = str(tmp_path / "server.sock")
+    with server.InferenceServer(address, Recognizer(), cp, max_wait=0.2):
+        client = server.InferenceClient(address)
+        remote = server.RemoteComparator(client)
+        assert client.recognize([np.zeros(800), np.zeros(1600)]) == [
+            "800", "1600"]
+
+        scores = [None] * 4
+
+        def score(i):
+            scores[i] = remote.compare(references[i], attempts[i],
+                                       key=("0123abcd", i, i + 1))
+        threads = [threading.Thread(target=score, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Concurrent requests of equal length share one model call and
+        # score like the in-process comparator.
+        assert client.info["compare"]["batches"] < 4
+        assert scores == pytest.approx(
+            [cp.compare(r, a) for r, a in zip(references, attempts)],
+            rel=1e-4)
+        assert remote.compare(references[0], attempts[0],
+                              key=("0123abcd", 0, 1)) == pytest.approx(scores[0])
+        assert os.path.isdir(tmp_path / "features" / "0123abcd")
+
+        for key in (("../..", 0, 1), ("0123abcd", 0), ("0123abcd", 0, "1")):
+            with pytest.raises(RuntimeError, match="X-Key"):
+                client.score(references[0], attempts[0], key)
+        assert os.listdir(tmp_path / "features") == ["0123abcd"]
+
+        # A too short attempt only fails its own request.
+        results = [None] * 2
+
+        def attempt(i, audio):
+            try:
+                results[i] = remote.compare(references[i], audio)
+            except RuntimeError as e:
+                results[i] = e
+        threads = [threading.Thread(target=attempt, args=(i, audio))
+                   for i, audio in enumerate((attempts[0], torch.randn(8010)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results[0] == pytest.approx(scores[0])
+        assert isinstance(results[1], RuntimeError)
+
+
+def test_comparator_layer():
+    audio = torch.randn(16000)
+    full = torchaudio.models.wav2vec2_base()
+    full.eval()
+    models = ModelRegistry()
+    cp = SpeechComparator(models=models, model="wav2vec2_base", layer=2)
+    cp.model.load_state_dict(full.state_dict(), strict=False)
+
+    assert len(cp.model.encoder.transformer.layers) == 3
+    features, _ = full.extract_features(audio.unsqueeze(0))
+    assert torch.allclose(cp.extract_features(audio), features[2][0], atol=1e-5)
+
+
+@pytest.mark.skipif(not speech_chunker.onnx_available(),
+                    reason="onnxruntime is not installed")
+def test_onnx_backend(tmp_path, monkeypatch):
+    monkeypatch.setenv("ECHOMASTER_CACHE", str(tmp_path / "cache"))
+    torch.save(torchaudio.models.wav2vec2_base().state_dict(),
+               tmp_path / "wav2vec2_base.pt")
+    models = ModelRegistry(str(tmp_path))
+    config = RuntimeConfig(backend="onnx")
+    assert config.backend == "onnx"
+    assert config.options("wav2vec2_base") == {"backend": "onnx"}
+    reference = SpeechComparator(models=models, model="wav2vec2_base", layer=2)
+    cp = SpeechComparator(models=models, model="wav2vec2_base", layer=2,
+                          runtime=config)
+    assert isinstance(cp.model, speech_chunker.OnnxModel)
+    # Lengths other than the one of the export run as well.
+    for audio in (torch.randn(16000), torch.randn(40000)):
+        assert torch.allclose(cp.extract_features(audio),
+                              reference.extract_features(audio), atol=1e-3)
+    exports = os.listdir(tmp_path / "cache" / "onnx")
+    assert exports
+    # Evicting audio, even from the cache root, keeps the exports.
+    for cache in (AudioCache(max_size=0), AudioCache(tmp_path / "cache")):
+        cache.max_size = 0
+    assert os.listdir(tmp_path / "cache" / "onnx") == exports
+
+
+@pytest.mark.skipif(not speech_chunker.onnx_available(),
+                    reason="onnxruntime is not installed")
+def test_onnx_models():
+    config = RuntimeConfig(backend="onnx")
+    vad = SpeechChunker(runtime=config)
+    stt = ShadowFormatter(vad, runtime=config)
+    audio = speech_chunker.waveform(bench.synthetic_speech(10))
+    probs = SpeechChunker().speech_probs(audio)
+    assert np.allclose(vad.speech_probs(audio), probs, atol=1e-3)
+    assert stt.subtitle(audio) == ShadowFormatter(vad).subtitle(audio)
+    report = RuntimeConfig().backends(audio[:16000 * 5], repeat=1)
+    assert all(report[i]["onnx"] is not None for i in report)
+
 
-    audio = add_noise(bc._data, noise=1e-2)
-    assert cp.compare(bc._data, audio) > 0.9
+def test_runtime_config():
+    threads = torch.get_num_threads()
+    config = RuntimeConfig(threads=2, quantize=True)
+    assert config.options("silero_vad") == {}
+    assert config.options("silero_stt") == {"jit_model": "jit_q"}
+    try:
+        cp = SpeechComparator(
+            models=ModelRegistry(), model="wav2vec2_base", runtime=config)
+        assert torch.get_num_threads() == 2
+    finally:
+        torch.set_num_threads(threads)
+    assert isinstance(
+        cp.model.encoder.transformer.layers[0].feed_forward.intermediate_dense,
+        torch.ao.nn.quantized.dynamic.Linear)
+    features = cp.extract_features(torch.randn(16000))
+    assert features.is_inference()
@@ -1,12 +1,20 @@
 from gi.repository import Gtk, GLib, Pango, Gdk
 import threading
-from speech_chunker import SpeechChunker, ShadowFormatter, SpeechComparator
+from speech_chunker import SpeechChunker, ShadowFormatter, SpeechComparator, ScoringService, SubtitleStore, Tracer, registry
+from scheduler import JobScheduler
 import pyaudio
 import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('Gdk', '4.0')
 
 
+def idle(function, *args):
+    def call():
+        function(*args)
+        return False
+    GLib.idle_add(call)
+
+
 class MainWindow(Gtk.Window):
     def __init__(self):
         super().__init__(title="Echo Master")
@@ -128,20 +136,51 @@ class MainWindow(Gtk.Window):
             4,
             1)
 
+        self.score = Gtk.Label()
+        self.grid.attach_next_to(
+            self.score, self.sub, Gtk.PositionType.BOTTOM, 4, 1)
+
         self.button = Gtk.ToggleButton(label="Start")
         self.button.connect("toggled", self.on_started)
         self.grid.attach_next_to(
-            self.button, self.sub, Gtk.PositionType.BOTTOM, 4, 1)
+            self.button, self.score, Gtk.PositionType.BOTTOM, 4, 1)
 
         self._bc = SpeechChunker()
         self._data = None
+        self._player = None
+        self._store = SubtitleStore()
         self._comparator = SpeechComparator()
+        self._scoring = ScoringService(self._comparator)
+        self._scheduler = JobScheduler(idle)
         self.stop_event = threading.Event()
+        self.connect("close-request", self.on_close_request)
+        self._scheduler.submit(
+            "preload", lambda job: registry.preload("silero_vad", "silero_stt"))
 
-    def on_delete_event(self, widget, event):
+    def on_close_request(self, window):
         self.stop_event.set()
+        self._scoring.skip()
+        self._scheduler.close(wait=False)
         return False
 
+    def on_scored(self, score):
+        idle(self.score.set_text, "Score: {:.2f}".format(score))
+
+    def on_score_failed(self, error):
+        idle(self.score.set_text, "Score: error ({})".format(error))
+
+    def set_subtitle(self, text, size=16):
+        self.sub.set_markup(
+            "<span font_desc='Arial {}'>{}</span>".format(
+                size, GLib.markup_escape_text(text)))
+
+    def on_progress(self, stage):
+        self.set_subtitle("Loading ({})".format(stage))
+
+    def on_failed(self, error):
+        self.set_cursor(None)
+        self.set_subtitle("Error: {}".format(error))
+
     def on_output_changed(self, dropdown, param):
         if self._data:
             self._data.output_device = dropdown.get_selected()
@@ -150,60 +189,101 @@ class MainWindow(Gtk.Window):
         if self._data:
             self._data.input_device = dropdown.get_selected()
 
-    def waiting(func):
-        def inner(*args, **kwargs):
-            args[0].set_cursor(Gdk.Cursor.new_from_name("progress"))
-            GLib.MainContext.default().iteration(False)
-            try:
-                return func(*args, **kwargs)
-            finally:
-                args[0].set_cursor(None)
-        return inner
-
-    @waiting
+    def submit(self, name, function, *args):
+        # Jobs on the chunker run in order in the background, a newer one
+        # supersedes those still waiting.
+        self.set_cursor(Gdk.Cursor.new_from_name("progress"))
+        return self._scheduler.submit(
+            name, function, *args, lane="chunker", on_done=self.on_done,
+            on_error=self.on_failed, on_progress=self.on_progress)
+
+    def on_done(self, data):
+        if not self._scheduler.busy("chunker"):
+            self.set_cursor(None)
+        if self._data is not None and self._data is not data:
+            # The previous track's prefetch worker and audio streams.
+            self._data.stop()
+            self._data.close()
+        self._data = data
+        self.set_subtitle("Subtitle!", 20)
+
+    def wait_playback(self, data):
+        # Jobs change the chunker the playback thread iterates, stop_event
+        # is already set.
+        player = self._player
+        if player is not None:
+            player.join()
+        if data is not None:
+            data.stop()
+
+    def load_track(self, job, url, data):
+        self.wait_playback(data)
+        self._bc.tracer = Tracer(lambda event: job.progress(event["name"]))
+        try:
+            self._bc.url = url
+            self._bc.load(stream=True)
+        finally:
+            self._bc.tracer = None
+        return ShadowFormatter(self._bc, lookahead=2, store=self._store)
+
+    def rechunk(self, job, chunk_duration, data):
+        self.wait_playback(data)
+        self._bc.tracer = Tracer(lambda event: job.progress(event["name"]))
+        try:
+            self._bc.chunk_duration = chunk_duration
+        finally:
+            self._bc.tracer = None
+        return data
+
     def on_loaded(self, button):
-        self._bc.url = self.entry.get_text()
-        self._bc.load()
-        self._data = ShadowFormatter(self._bc)
+        self.stop_event.set()
+        self.submit("load", self.load_track, self.entry.get_text(),
+                    self._data)
 
-    @waiting
     def on_chunker_changed(self, value):
         if self._data:
-            self._bc.chunk_duration = int(self.max_chunk.get_value())
+            self.stop_event.set()
+            self.submit("rechunk", self.rechunk,
+                        int(self.max_chunk.get_value()), self._data)
 
-    @waiting
     def on_formatter_changed(self, value):
         if self._data:
             ...
 
-    def run_audio(self):
-        for s, p in self._data:
+    def run_audio(self, data):
+        data.start(self.stop_event)
+        for s, p in data:
             for _ in range(int(self.repeat.get_value())):
                 if self.stop_event.is_set():
                     break
-                GLib.idle_add(
-                    self.sub.set_markup, "<span font_desc='Arial 16'>{}</span>".format(s))
-                record = self._data.play(p)
-                if self.replay_checkbox.get_active():
-                    self._data.play(record)
-                # self._comparator.compare(p, record) # TODO more robust metric
+                idle(self.set_subtitle, s)
+                record = data.play(p)
+                if record is not None and self.replay_checkbox.get_active():
+                    data.play(record[len(record) // 2:])
+                if record is not None:
+                    self._scoring.submit(p, record, callback=self.on_scored,
+                                         on_error=self.on_score_failed)
         else:
-            self._data.reset()
+            data.reset()
 
-        self.button.set_active(False)
-        self.button.set_label("Play")
+        idle(self.button.set_active, False)
+        idle(self.button.set_label, "Play")
 
     def on_started(self, button):
-        if self._data is None:
+        # Loading and re-chunking wait for the playback thread.
+        if self._data is None or self._scheduler.busy("chunker"):
+            self.button.set_active(False)
             return
 
         if self.button.get_active():
             self.button.set_label("Stop")
             self.stop_event.clear()
-            thread = threading.Thread(target=self.run_audio)
-            thread.start()
+            self._player = threading.Thread(
+                target=self.run_audio, args=(self._data,))
+            self._player.start()
         else:
             self.stop_event.set()
+            self._scoring.skip()
 
     def list_audio_devices(self):
         p = pyaudio.PyAudio()
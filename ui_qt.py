@@ -1,22 +1,32 @@
 from PySide6.QtWidgets import (QApplication, QWidget, QGridLayout, QPushButton, QLineEdit, QLabel,
                                QSpinBox, QCheckBox, QComboBox, QPlainTextEdit)
-from PySide6.QtCore import Qt, QThread, Signal
+from PySide6.QtCore import Qt, QObject, QThread, Signal, Slot
+import functools
 import pyaudio
 import threading
-from speech_chunker import SpeechChunker, ShadowFormatter, SpeechComparator
+from speech_chunker import SpeechChunker, ShadowFormatter, SpeechComparator, ScoringService, SubtitleStore, Tracer, registry
+from scheduler import JobScheduler
 
 
-def waiting(func):
-    def inner(*args, **kwargs):
-        QApplication.setOverrideCursor(Qt.WaitCursor)
-        try:
-            return func(*args, **kwargs)
-        finally:
-            QApplication.restoreOverrideCursor()
-    return inner
+class Invoker(QObject):
+    invoked = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        # Queued, so calls emitted from any thread run on this object's
+        # (the GUI) thread.
+        self.invoked.connect(self.call, Qt.QueuedConnection)
+
+    @Slot(object)
+    def call(self, call):
+        call()
+
+    def __call__(self, function, *args):
+        self.invoked.emit(functools.partial(function, *args))
 
 
 class MainWindow(QWidget):
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Echo Master")
@@ -72,21 +82,102 @@ class MainWindow(QWidget):
         self.subtitle_label.setAlignment(Qt.AlignCenter)
         self.layout.addWidget(self.subtitle_label, 5, 0, 1, 4)
 
+        self.score_label = QLabel()
+        self.score_label.setAlignment(Qt.AlignCenter)
+        self.layout.addWidget(self.score_label, 6, 0, 1, 4)
+
         self.start_button = QPushButton("Start")
         self.start_button.setCheckable(True)
         self.start_button.clicked.connect(self.on_started)
-        self.layout.addWidget(self.start_button, 6, 0, 1, 4)
+        self.layout.addWidget(self.start_button, 7, 0, 1, 4)
 
         self._bc = SpeechChunker()
         self._data = None
+        self._player = None
+        self._store = SubtitleStore()
         self._comparator = SpeechComparator()
+        self._scoring = ScoringService(self._comparator)
+        self._invoke = Invoker()
+        self._scheduler = JobScheduler(self._invoke)
         self.stop_event = threading.Event()
+        self._scheduler.submit(
+            "preload", lambda job: registry.preload("silero_vad", "silero_stt"))
+
+    def closeEvent(self, event):
+        self.stop_event.set()
+        self._scoring.skip()
+        self._scheduler.close(wait=False)
+        super().closeEvent(event)
+
+    def on_scored(self, score):
+        self._invoke(self.score_label.setText, "Score: {:.2f}".format(score))
+
+    def on_score_failed(self, error):
+        self._invoke(self.score_label.setText,
+                     "Score: error ({})".format(error))
+
+    def on_progress(self, stage):
+        self.subtitle_label.setText("Loading ({})".format(stage))
+
+    def on_failed(self, error):
+        self.restore_cursor()
+        self.subtitle_label.setText("Error: {}".format(error))
+
+    def restore_cursor(self):
+        while QApplication.overrideCursor() is not None:
+            QApplication.restoreOverrideCursor()
+
+    def submit(self, name, function, *args):
+        # Jobs on the chunker run in order in the background, a newer one
+        # supersedes those still waiting.
+        if QApplication.overrideCursor() is None:
+            QApplication.setOverrideCursor(Qt.WaitCursor)
+        return self._scheduler.submit(
+            name, function, *args, lane="chunker", on_done=self.on_done,
+            on_error=self.on_failed, on_progress=self.on_progress)
+
+    def on_done(self, data):
+        if not self._scheduler.busy("chunker"):
+            self.restore_cursor()
+        if self._data is not None and self._data is not data:
+            # The previous track's prefetch worker and audio streams.
+            self._data.stop()
+            self._data.close()
+        self._data = data
+        self.subtitle_label.setText("Subtitle!")
+
+    def wait_playback(self, data):
+        # Jobs change the chunker the playback thread iterates, stop_event
+        # is already set.
+        player = self._player
+        if player is not None:
+            player.join()
+        if data is not None:
+            data.stop()
+
+    def load_track(self, job, url, data):
+        self.wait_playback(data)
+        self._bc.tracer = Tracer(lambda event: job.progress(event["name"]))
+        try:
+            self._bc.url = url
+            self._bc.load(stream=True)
+        finally:
+            self._bc.tracer = None
+        return ShadowFormatter(self._bc, lookahead=2, store=self._store)
+
+    def rechunk(self, job, chunk_duration, data):
+        self.wait_playback(data)
+        self._bc.tracer = Tracer(lambda event: job.progress(event["name"]))
+        try:
+            self._bc.chunk_duration = chunk_duration
+        finally:
+            self._bc.tracer = None
+        return data
 
-    @waiting
     def on_loaded(self):
-        self._bc.url = self.entry.text()
-        self._bc.load()
-        self._data = ShadowFormatter(self._bc)
+        self.stop_event.set()
+        self.submit("load", self.load_track, self.entry.text(),
+                    self._data)
 
     def on_output_changed(self, value):
         if self._data:
@@ -96,37 +187,45 @@ class MainWindow(QWidget):
         if self._data:
             self._data.input_device = value
 
-    @waiting
     def on_chunker_changed(self, value):
         if self._data:
-            self._bc.chunk_duration = value
+            self.stop_event.set()
+            self.submit("rechunk", self.rechunk, value, self._data)
 
-    def run_audio(self):
-        for s, p in self._data:
+    def run_audio(self, data):
+        data.start(self.stop_event)
+        for s, p in data:
             for _ in range(self.repeat_spinbox.value()):
                 if self.stop_event.is_set():
                     break
-                self.subtitle_label.setText(s)
-                record = self._data.play(p)
-                if self.replay_checkbox.isChecked():
-                    self._data.play(record)
+                self._invoke(self.subtitle_label.setText, s)
+                record = data.play(p)
+                if record is not None and self.replay_checkbox.isChecked():
+                    data.play(record[len(record) // 2:])
+                if record is not None:
+                    self._scoring.submit(p, record, callback=self.on_scored,
+                                         on_error=self.on_score_failed)
         else:
-            self._data.reset()
+            data.reset()
 
-        self.start_button.setChecked(False)
-        self.start_button.setText("Start")
+        self._invoke(self.start_button.setChecked, False)
+        self._invoke(self.start_button.setText, "Start")
 
     def on_started(self):
-        if self._data is None:
+        # Loading and re-chunking wait for the playback thread.
+        if self._data is None or self._scheduler.busy("chunker"):
+            self.start_button.setChecked(False)
             return
 
         if self.start_button.isChecked():
             self.start_button.setText("Stop")
             self.stop_event.clear()
-            thread = threading.Thread(target=self.run_audio)
-            thread.start()
+            self._player = threading.Thread(
+                target=self.run_audio, args=(self._data,))
+            self._player.start()
         else:
             self.stop_event.set()
+            self._scoring.skip()
             self.start_button.setText("Start")
 
     def list_audio_devices(self):